@@ -7,16 +7,19 @@ import sys
 import types
 import collections
 import copy
+import calendar
+import threading
 import functools
 import pathlib # only needed to pass a pathlib.Path to scss compiler
 import logging
+import urllib.parse
 import OpenSSL as openssl
 import werkzeug
 import click
 import flask
 
 import jinja2
-from playhouse import db_url
+from playhouse import db_url, pool
 import peewee
 import scss # pyScss
 
@@ -34,9 +37,59 @@ from jinja2 import Markup
 from . import helpers
 from . import errors
 from . import defaults
+from . import caching
 
 db_url.schemes['sqlite'] = db_url.schemes['sqliteext'] # Make sure we get the extensible sqlite database, so we can make regular expressions case-sensitive. see https://github.com/coleifer/peewee/issues/1221
 
+
+class PoolStatistics(object):
+
+    """
+    Mixin for playhouse.pool databases exposing usage statistics, so pools can be sized.
+    """
+
+    waits = 0 # number of connect() calls that found the pool exhausted, no matter how often they retried
+    _exhausted = threading.local() # whether the current threads' connect() hit an exhausted pool
+
+    def connect(self, *args, **kwargs):
+
+        self._exhausted.hit = False
+
+        try:
+            return super(PoolStatistics, self).connect(*args, **kwargs)
+
+        finally:
+            if self._exhausted.hit: # peewee retries _connect every 0.1s until its timeout, count those as one wait
+                self.waits += 1
+
+
+    def _connect(self, *args, **kwargs):
+
+        try:
+            return super(PoolStatistics, self)._connect(*args, **kwargs)
+
+        except pool.MaxConnectionsExceeded:
+            self._exhausted.hit = True
+            raise
+
+
+    @property
+    def pool_stats(self):
+
+        return collections.OrderedDict([
+            ('max_connections', self._max_connections),
+            ('in_use', len(self._in_use)),
+            ('idle', len(self._connections)),
+            ('waits', self.waits)
+        ])
+
+
+for scheme, database_class in list(db_url.schemes.items()):
+    if scheme.endswith('+pool') and database_class is not None: # peewee sets schemes to None if their driver or extension is missing
+        db_url.schemes[scheme] = type(database_class.__name__, (PoolStatistics, database_class), {})
+
+db_url.schemes['sqlite+pool'] = db_url.schemes['sqliteext+pool'] # see above
+
 import __main__ # to look up project name
 
 if hasattr(__main__, '__file__'):
@@ -204,6 +257,18 @@ class Poobrain(flask.Flask):
     site = None
     admin = None
     boxes = None
+    identity_cache = None
+    box_cache = None
+    page_cache = None
+    fragment_cache = None
+    count_cache = None
+    captcha_cache = None
+    markdown_cache = None
+    template_resolutions = None
+    template_mtime = None
+    permission_cache = None
+    endpoint_index = None
+    endpoint_choices = None
     resource_extension_whitelist = None
     error_codes = {
         peewee.OperationalError: 500,
@@ -219,6 +284,10 @@ class Poobrain(flask.Flask):
         if not 'root_path' in kwargs:
             kwargs['root_path'] = str(pathlib.Path('.').absolute()) #TODO: pathlib probably isn't really needed here
 
+        # set up before flask registers its first url rule (static)
+        self.endpoint_index = {} # endpoint -> [(arguments, optional arguments)] for each of its url rules
+        self.endpoint_choices = {} # (endpoints, url parameter names) -> endpoint, see Pooprint.choose_endpoint
+
         super(Poobrain, self).__init__(*args, **kwargs)
 
         self.cronjobs = []
@@ -272,7 +341,17 @@ class Poobrain(flask.Flask):
                 import signal # shouldn't be needed but feels hacky to leave out
                 import pdb
 
-        self.boxes = {}
+        self.boxes = collections.OrderedDict()
+        self.page_cache = caching.LRUCache(maxsize=self.config['PAGE_CACHE_SIZE'], ttl=self.config['CACHE_SHORT']) # rendered pages for the anonymous user, see helpers.themed
+        self.template_resolutions = {} # (template_cache_key, theme) -> name of the template that won, see Renderable.template
+        self.template_mtime = 0
+        self.fragment_cache = caching.LRUCache(maxsize=self.config['FRAGMENT_CACHE_SIZE'], ttl=self.config['CACHE_SHORT']) # rendered Storables, see Storable.fragment_cache_key
+        self.count_cache = caching.LRUCache(maxsize=self.config['COUNT_CACHE_SIZE'], ttl=self.config['COUNT_CACHE_TTL']) # (sql, params) -> row count, see storage.count
+        self.box_cache = caching.LRUCache(maxsize=self.config['BOX_CACHE_SIZE']) # for boxes with 'user' or 'global' cache policy
+        self.markdown_cache = caching.LRUCache(maxsize=self.config['MARKDOWN_CACHE_SIZE']) # source hash -> rendered html, see md.MarkdownString
+        self.captcha_cache = caching.LRUCache(maxsize=self.config['CAPTCHA_CACHE_SIZE'], ttl=self.config['TOKEN_VALIDITY']) # captcha -> rendered png, see commenting.Challenge
+        self.identity_cache = caching.LRUCache(maxsize=self.config['IDENTITY_CACHE_SIZE'], ttl=self.config['IDENTITY_CACHE_TTL']) # client certificate -> user, shared across requests
+        self.permission_cache = caching.LRUCache(maxsize=self.config['PERMISSION_CACHE_SIZE'], ttl=self.config['PERMISSION_CACHE_TTL']) # user id -> compiled permissions, see User.permission_table
         self.poobrain_path = os.path.dirname(os.path.realpath(__file__))
         self.site_path = os.getcwd()
         self.resource_extension_whitelist = ['css', 'scss', 'png', 'svg', 'ttf', 'otf', 'woff', 'js', 'jpg']
@@ -280,7 +359,24 @@ class Poobrain(flask.Flask):
         self.scss_compiler = scss.Compiler(extensions=(SCSSCore,), root=pathlib.Path('/'), search_path=self.theme_paths)
 
         if 'DATABASE' in self.config:
-            self.db = db_url.connect(self.config['DATABASE'], autocommit=True, autorollback=True)
+
+            connect_params = {'autocommit': True, 'autorollback': True}
+
+            url = urllib.parse.urlparse(self.config['DATABASE'])
+            if url.scheme.endswith('+pool'):
+
+                pool_params = {
+                    'max_connections': self.config['DATABASE_POOL_MAX_CONNECTIONS'],
+                    'stale_timeout': self.config['DATABASE_POOL_STALE_TIMEOUT'],
+                    'timeout': self.config['DATABASE_POOL_TIMEOUT']
+                }
+
+                url_params = urllib.parse.parse_qs(url.query)
+                for name, value in pool_params.items():
+                    if not name in url_params: # parameters in the URL take precedence over config
+                        connect_params[name] = value
+
+            self.db = db_url.connect(self.config['DATABASE'], **connect_params)
 
         else:
 
@@ -397,8 +493,11 @@ class Poobrain(flask.Flask):
 
 
     def request_setup(self):
+
+        if self.debug:
+            self.template_check()
        
-        flask.g.boxes = {}
+        flask.g.boxes = helpers.LazyBoxes(cache=self.box_cache)
         flask.g.forms = {}
         #self.db.close() # fails first request and thus always on sqlite
         if self.db.is_closed():
@@ -415,15 +514,42 @@ class Poobrain(flask.Flask):
                 raise werkzeug.exceptions.InternalServerError("httpd configuration problem. SSL_CLIENT_VERIFY not set in request environment.")
 
         if flask.request.environ['SSL_CLIENT_VERIFY'] == 'SUCCESS':
- 
-            try:
-                #cert_info = auth.ClientCert.get(auth.ClientCert.subject_name == flask.request.environ['SSL_CLIENT_S_DN'])
-                cert = openssl.crypto.load_certificate(openssl.crypto.FILETYPE_PEM, flask.request.environ['SSL_CLIENT_CERT']) 
-                cert_info = auth.ClientCert.get(auth.ClientCert.fingerprint == cert.digest('sha512').replace(':', '')) # fuck colons
-                flask.g.user = cert_info.user
 
-            except auth.ClientCert.DoesNotExist:
-                self.logger.error("httpd verified client certificate successfully, but it's not known at this site. CN: %s, digest: %s" % (cert.get_subject().CN, cert.digest('sha512')))
+            cert_pem = flask.request.environ['SSL_CLIENT_CERT']
+            identity_version = helpers.shared_version('identities') # bumped by writes to ClientCert and User in any process
+            identity = self.identity_cache.get(cert_pem)
+
+            if identity is not None and identity['version'] != identity_version:
+                identity = None
+
+            if identity is None:
+
+                try:
+                    #cert_info = auth.ClientCert.get(auth.ClientCert.subject_name == flask.request.environ['SSL_CLIENT_S_DN'])
+                    cert = openssl.crypto.load_certificate(openssl.crypto.FILETYPE_PEM, cert_pem) 
+                    cert_info = auth.ClientCert.get(auth.ClientCert.fingerprint == cert.digest('sha512').replace(':', '')) # fuck colons
+                    user = cert_info.user
+
+                    identity = {
+                        'version': identity_version,
+                        'cert_id': cert_info.id,
+                        'user_id': user.id,
+                        'user_data': dict(user.__data__) # the preloaded User row
+                    }
+
+                    expires = None
+                    if cert_info.not_after:
+                        expires = calendar.timegm(cert_info.not_after.utctimetuple()) # not_after is UTC. expired certs must not outlive it in the cache
+
+                    self.identity_cache.set(cert_pem, identity, expires=expires)
+
+                except auth.ClientCert.DoesNotExist:
+                    self.logger.error("httpd verified client certificate successfully, but it's not known at this site. CN: %s, digest: %s" % (cert.get_subject().CN, cert.digest('sha512')))
+
+            if identity is not None:
+                # build a fresh instance for every request so per-instance caches (permissions, groups) don't leak between requests
+                flask.g.user = auth.User(__no_default__=1, **identity['user_data'])
+                flask.g.user._dirty.clear()
 
         if flask.g.user == None:
             try:
@@ -437,18 +563,59 @@ class Poobrain(flask.Flask):
     def request_teardown(self, exception):
 
         if not self.db.is_closed():
-            self.db.close()
+            self.db.close() # for pooled databases, this hands the connection back to the pool
+
+
+    def template_check(self):
+
+        """
+        Forget remembered template resolutions if templates were added,
+        removed or renamed in any theme path. Only used in debug mode,
+        as it walks all theme directories.
+        """
+
+        mtime = 0
+        for theme_path in self.theme_paths:
+            for dirpath, _, _ in os.walk(theme_path):
+                mtime = max(mtime, os.stat(dirpath).st_mtime) # directory mtimes change when files are added/removed
+
+        if mtime != self.template_mtime:
+            self.template_resolutions.clear()
+            self.template_mtime = mtime
+
+
+    @property
+    def db_pooled(self):
+        return isinstance(self.db, PoolStatistics)
 
     def box_setup(self):
+
+        """ Make registered boxes available in `flask.g.boxes`. They're only evaluated when accessed. """
         
-        for name, f in self.boxes.items():
-            flask.g.boxes[name] = f()
+        for name, (f, cache, ttl) in self.boxes.items():
+            flask.g.boxes.register(name, f, cache=cache, ttl=ttl)
 
     
-    def box(self, name):
+    def box(self, name, cache='request', ttl=None):
+
+        """
+        decorator. Register a box function.
+
+        Parameters:
+        * cache: 'request' (default) runs the box once per request, 'user'
+                 caches it per user and 'global' for everybody, both across
+                 requests.
+        * ttl: Seconds a cross-request cached box lives, defaults to CACHE_SHORT.
+        """
+
+        if not cache in helpers.LazyBoxes.policies:
+            raise ValueError("Unknown cache policy '%s' for box '%s'." % (cache, name))
+
+        if ttl is None:
+            ttl = self.config['CACHE_SHORT']
 
         def decorator(f):
-            self.boxes[name] = f
+            self.boxes[name] = (f, cache, ttl)
             return f
 
         return decorator
@@ -506,7 +673,7 @@ class Poobrain(flask.Flask):
 
         except LookupError:
 
-            blueprint_names = self.blueprints.keys()
+            blueprint_names = list(self.blueprints.keys())
             
             blueprint_names.pop(blueprint_names.index('admin'))
             blueprint_names.insert(0, 'admin')
@@ -532,6 +699,36 @@ class Poobrain(flask.Flask):
             raise LookupError("Failed generating URL for %s[%s]-%s. No matching route found." % (cls.__name__, url_params.get('handle', None), mode))
 
 
+    def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
+
+        super(Poobrain, self).add_url_rule(rule, endpoint=endpoint, view_func=view_func, **options)
+
+        self.endpoint_choices.clear() # new rules can change which endpoint fits best
+
+        if endpoint is None: # flask derived it from view_func, index lazily in endpoint_rules
+            return
+
+        self.endpoint_index[endpoint] = [(frozenset(r.arguments), frozenset(r.defaults or {})) for r in self.url_map.iter_rules(endpoint)]
+
+
+    def endpoint_rules(self, endpoint):
+
+        """ The (arguments, optional arguments) pairs of all url rules of `endpoint`. """
+
+        try:
+            return self.endpoint_index[endpoint]
+
+        except KeyError:
+
+            try:
+                rules = [(frozenset(r.arguments), frozenset(r.defaults or {})) for r in self.url_map.iter_rules(endpoint)]
+            except KeyError: # unknown endpoint
+                rules = []
+
+            self.endpoint_index[endpoint] = rules
+            return rules
+
+
     def get_related_view_url(self, cls, handle, related_field, add=None):
         
         blueprint = self.blueprints[flask.request.blueprint]
@@ -669,14 +866,23 @@ class Pooprint(flask.Blueprint):
 
     def box_setup(self):
         
-        for name, f in self.boxes.items():
-            flask.g.boxes[name] = f()
+        for name, (f, cache, ttl) in self.boxes.items():
+
+            if ttl is None:
+                ttl = self.app.config['CACHE_SHORT']
+
+            flask.g.boxes.register(name, f, cache=cache, ttl=ttl)
 
     
-    def box(self, name):
+    def box(self, name, cache='request', ttl=None):
+
+        """ decorator. Register a box for this blueprint, see `Poobrain.box` for parameters. """
+
+        if not cache in helpers.LazyBoxes.policies:
+            raise ValueError("Unknown cache policy '%s' for box '%s'." % (cache, name))
 
         def decorator(f):
-            self.boxes[name] = f
+            self.boxes[name] = (f, cache, ttl) # ttl None means CACHE_SHORT, resolved in box_setup because there's no app bound yet
             return f
 
         return decorator
@@ -742,19 +948,35 @@ class Pooprint(flask.Blueprint):
 
 
     def choose_endpoint(self, endpoints, **url_params):
-        
-        for rule in self.app.url_map.iter_rules():
-            if rule.endpoint in endpoints:
-                endpoint = rule.endpoint
-                not_too_many_params = set(url_params.keys()).issubset(rule.arguments)
-                missing_params = rule.arguments - set(url_params.keys())
-                missing_all_optional = all([param in rule.defaults.keys() for param in missing_params])
-                #if sorted(rule.arguments) == sorted(url_params.keys()): # means url parameters match perfectly
-                #if set(url_params.keys()).issubset(rule.arguments):
-                if not_too_many_params and missing_all_optional:
-                    return endpoint
 
-        raise ValueError("No fitting url rule found for all params: %s", ','.join(url_params.keys()))
+        params = frozenset(url_params.keys())
+        key = (tuple(endpoints), params)
+
+        try:
+            endpoint = self.app.endpoint_choices[key]
+
+        except KeyError:
+
+            endpoint = None
+            for candidate in endpoints:
+                for arguments, optional in self.app.endpoint_rules(candidate):
+
+                    not_too_many_params = params.issubset(arguments)
+                    missing_all_optional = (arguments - params).issubset(optional)
+
+                    if not_too_many_params and missing_all_optional:
+                        endpoint = candidate
+                        break
+
+                if endpoint is not None:
+                    break
+
+            self.app.endpoint_choices[key] = endpoint # remember misses too, they're just as expensive
+
+        if endpoint is None:
+            raise ValueError("No fitting url rule found for all params: %s" % ','.join(url_params.keys()))
+
+        return endpoint
 
 
     def get_url(self, cls, mode=None, **url_params):
@@ -793,26 +1015,17 @@ class Pooprint(flask.Blueprint):
         if mode == None:
             mode = 'teaser'
 
-        if handle is not None:
-
-            instance = cls.load(handle)
-
-            clauses = []
-            for ordering in cls._meta.order_by: # Ordering is a peewee.WrappedNode, its .node property is the field
-
-                if ordering.direction == 'ASC':
-                    clauses.append(ordering.node <= getattr(instance, ordering.node.name))
-                else: # We'll just assume there can only be ASC and DESC
-                    clauses.append(ordering.node >= getattr(instance, ordering.node.name))
-
-            offset = cls.select().where(*clauses).count() - 1
-
         if not cls in self.listings:
             raise LookupError("No registered listings for class %s." % (cls.__name__,))
 
         if not mode in self.listings[cls]:
             raise LookupError("No registered listings for class %s with mode %s." % (cls.__name__, mode))
 
+        if handle is not None:
+
+            limit = self.app.config['PAGINATION_COUNT']
+            offset = (cls.position(handle) // limit) * limit # offset of the page the instance is on
+
         endpoints = ['%s.%s' % (self.name, x) for x in self.listings[cls][mode]]
         endpoint = self.choose_endpoint(endpoints)
 
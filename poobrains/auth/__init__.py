@@ -18,6 +18,7 @@ import datetime
 import werkzeug
 import click
 import peewee
+import flask
 
 
 # local imports
@@ -394,9 +395,11 @@ class Permission(poobrains.helpers.ChildAware):
     @classmethod
     def check(cls, user):
 
+        own_permissions = user.permission_table['own']
+
         # check user-assigned permission state
-        if cls.__name__ in user.own_permissions:
-            access = user.own_permissions[cls.__name__]
+        if cls.__name__ in own_permissions:
+            access = own_permissions[cls.__name__]
 
             if access == 'deny':
                 raise AccessDenied("YOU SHALL NOT PASS!")
@@ -404,25 +407,13 @@ class Permission(poobrains.helpers.ChildAware):
             elif access == 'grant':
                 return True
 
+        group_access = user.permission_table['groups'].get(cls.__name__, {})
+
         # check if user is member of any groups with 'deny' for this permission
-        # group_deny = GroupPermission.select().join(Group).join(UserGroup).join(User).where(UserGroup.user == user, GroupPermission.permission == cls.__name__, GroupPermission.access == 'deny').count()
-        group_deny = False
-        for group in user.groups:
-            if cls.__name__ in group.own_permissions and group.own_permissions[cls.__name__] == 'deny':
-                group_deny = True
-                break
-
-        if group_deny:
+        if 'deny' in group_access:
             raise AccessDenied("YOU SHALL NOT PASS!")
 
-        #group_grant = GroupPermission.select().join(Group).join(UserGroup).join(User).where(UserGroup.user == user, GroupPermission.permission == cls.__name__, GroupPermission.access == 'grant').count()
-        group_grant = False
-        for group in user.groups:
-            if cls.__name__ in group.own_permissions and group.own_permissions[cls.__name__] == 'grant':
-                group_grant = True
-                break
-
-        if group_grant:
+        if 'grant' in group_access:
             return True
 
         raise AccessDenied("YOU SHALL NOT PASS!")
@@ -435,27 +426,54 @@ class Permission(poobrains.helpers.ChildAware):
     @classmethod
     def list(cls, protected, q, op, user): # FIXME: should op be implied, not directly passed?
 
-        if cls.__name__ in user.own_permissions:
-            access = user.own_permissions[cls.__name__]
+        predicate = cls.predicate(protected, op, user)
 
-            if access == 'deny':
-                raise AccessDenied("YOU SHALL NOT PASS!")
-            elif access == 'grant':
-                return q
-        
-        # check if user is member of any groups with 'deny' for this permission
-        group_deny = GroupPermission.select().join(Group).join(UserGroup).join(User).where(UserGroup.user == user, GroupPermission.permission == cls.__name__, GroupPermission.access == 'deny').count()
+        if predicate is True:
+            return q
 
-        if group_deny:
-            raise AccessDenied("YOU SHALL NOT PASS!")
+        return q.where(predicate)
 
-        group_grant = GroupPermission.select().join(Group).join(UserGroup).join(User).where(UserGroup.user == user, GroupPermission.permission == cls.__name__, GroupPermission.access == 'grant').count()
 
-        if group_grant:
-            return q
+    @classmethod
+    def predicate(cls, protected, op, user):
 
+        """
+        SQL condition limiting rows to the ones `user` may `op`. `protected`
+        can be anything with owner, group and access fields, not only the
+        Protected class itself. True means no rows are excluded, raises
+        AccessDenied if none are allowed.
+        """
+
+        cls.check(user) # plain permissions don't filter rows, it's all or nothing
+        return True
 
-        raise AccessDenied("YOU SHALL NOT PASS!")
+
+    @staticmethod
+    def resolve(user, permission_names):
+
+        """
+        Resolve a batch of permissions for `user` in one go.
+
+        Returns an OrderedDict mapping each name in `permission_names` to
+        'grant' or 'deny'. For OwnedPermissions, 'grant' means the user may
+        get a listing at all, rows are still filtered by `list`.
+        All lookups go against `user.permission_table`, so this costs at
+        most one compilation of that table, no matter the number of names.
+        """
+
+        permissions = Permission.class_children_keyed()
+        resolved = collections.OrderedDict()
+
+        for name in permission_names:
+
+            try:
+                permissions[name].check(user)
+                resolved[name] = 'grant'
+
+            except (KeyError, AccessDenied):
+                resolved[name] = 'deny'
+
+        return resolved
 
 
 class AccessAdminArea(Permission):
@@ -582,9 +600,13 @@ def admin_index():
         AccessAdminArea.check(g.user)
 
         container = poobrains.rendering.Container(title='Administration', mode='full')
+        readable = Permission.resolve(g.user, [administerable.permissions['read'].__name__ for administerable in app.admin.listings])
         
         for administerable, listings in app.admin.listings.items():
 
+            if readable[administerable.permissions['read'].__name__] == 'deny':
+                continue # don't link to listings that would only greet the user with an error
+
             subcontainer = poobrains.rendering.Container(css_class='administerable-actions', mode='full')
             menu = poobrains.rendering.Menu('listings-%s' % administerable.__name__)
             for mode, endpoints in listings.items():
@@ -603,6 +625,24 @@ def admin_index():
         return None
 
 
+@app.admin.route('/database/')
+@poobrains.helpers.themed
+def admin_database():
+
+    """ Show connection pool statistics, for sizing DATABASE_POOL_* settings. """
+
+    AccessAdminArea.check(g.user)
+
+    if not app.db_pooled:
+        return poobrains.rendering.RenderString("Connection pooling is disabled, use a pooled DATABASE url (like postgres+pool://) to enable it.", name='Database')
+
+    table = poobrains.rendering.Table(columns=['Statistic', 'Value'], name='Database connection pool')
+    for name, value in app.db.pool_stats.items():
+        table.append(name.replace('_', ' '), value)
+
+    return table
+
+
 def access(permission):
 
     def decorator(func):
@@ -775,8 +815,10 @@ class OwnedPermission(Permission):
     @classmethod
     def check(cls, user):
 
-        if cls.__name__ in user.own_permissions:
-            access = user.own_permissions[cls.__name__]
+        own_permissions = user.permission_table['own']
+
+        if cls.__name__ in own_permissions:
+            access = own_permissions[cls.__name__]
 
             if access == 'deny':
                 raise AccessDenied("YOU SHALL NOT PASS!")
@@ -804,10 +846,11 @@ class OwnedPermission(Permission):
     def instance_check(self, user):
 
         op_abbr = self.op_abbreviations[self.op]
+        own_permissions = user.permission_table['own']
 
-        if self.__class__.__name__ in user.own_permissions:
+        if self.__class__.__name__ in own_permissions:
 
-            access = user.own_permissions[self.__class__.__name__]
+            access = own_permissions[self.__class__.__name__]
 
             if access == 'deny':
                 raise AccessDenied("YOU SHALL NOT PASS!")
@@ -845,7 +888,7 @@ class OwnedPermission(Permission):
 
             elif 'own_instance' in group_access.keys():
                 allowed_groups = group_access['own_instance']
-                if self.instance.group in allowed_groups and op_abbr in self.instance.access:
+                if self.instance.group_id in allowed_groups and op_abbr in self.instance.access:
                     return True
                 else:
                     raise AccessDenied("YOU SHALL NOT PASS!")
@@ -858,7 +901,7 @@ class OwnedPermission(Permission):
 
             elif 'own' in group_access.keys():
                 allowed_groups = group_access['own']
-                if self.instance.group in allowed_groups:
+                if self.instance.group_id in allowed_groups:
                     return True
                 else:
                     raise AccessDenied("YOU SHALL NOT PASS!")
@@ -872,41 +915,36 @@ class OwnedPermission(Permission):
     @classmethod
     def group_access(cls, user):
 
-        group_access = collections.OrderedDict()
-        for group in user.groups:
-            if cls.__name__ in group.own_permissions:
-                access = group.own_permissions[cls.__name__]
-                if not access in group_access:
-                    group_access[access] = []
-                group_access[access].append(group)
+        """ Access modes the groups of `user` have for this permission, mapped to lists of the ids of the groups having them. """
 
-        return group_access
+        return user.permission_table['groups'].get(cls.__name__, collections.OrderedDict())
    
 
     @classmethod
-    def list(cls, protected, q, op, user): # FIXME: should op be implied, not directly passed?
+    def predicate(cls, protected, op, user):
         
         cls.check(user) # make sure the user is permitted to get a listing
 
         op_abbr = op[0]
+        own_permissions = user.permission_table['own']
 
-        if cls.__name__ in user.own_permissions:
+        if cls.__name__ in own_permissions:
 
-            access = user.own_permissions[cls.__name__]
+            access = own_permissions[cls.__name__]
             if access == 'deny':
                 raise AccessDenied("YOU SHALL NOT PASS!")
 
             elif access == 'own_instance':
-                return q.where(protected.owner == user, protected.access.contains(op_abbr))
+                return (protected.owner == user) & protected.access.contains(op_abbr)
 
             elif access == 'instance':
-                return q.where(protected.access.contains(op_abbr))
+                return protected.access.contains(op_abbr)
 
             elif access == 'own':
-                return q.where(protected.owner == user)
+                return protected.owner == user
 
             elif access == 'grant':
-                return q
+                return True
 
         else:
 
@@ -917,17 +955,17 @@ class OwnedPermission(Permission):
 
             elif 'own_instance' in group_access.keys():
                 allowed_groups = group_access['own_instance']
-                return q.where(protected.group.in_(allowed_groups), protected.access.contains(op_abbr))
+                return protected.group.in_(allowed_groups) & protected.access.contains(op_abbr)
 
             elif 'instance' in group_access.keys():
-                return q.where(protected.access.contains(op_abbr))
+                return protected.access.contains(op_abbr)
 
             elif 'own' in group_access.keys():
                 allowed_groups = group_access['own']
-                return q.where(protected.group.in_(allowed_groups))
+                return protected.group.in_(allowed_groups)
 
             elif 'grant' in group_access.keys():
-                return q
+                return True
 
         raise AccessDenied("YOU SHALL NOT PASS!") # implicit denial
 
@@ -1317,6 +1355,9 @@ class Named(Administerable, poobrains.storage.Named):
 
 class User(Named):
 
+    class Meta:
+        fragment_cache = False # profile rendering depends on offset and pagination
+
     mail = poobrains.storage.fields.CharField(null=True) # FIXME: implement an EmailField
     pgp_fingerprint = poobrains.storage.fields.CharField(null=True)
     mail_notifications = poobrains.storage.fields.BooleanField(default=False)
@@ -1354,6 +1395,101 @@ class User(Named):
         return groups
 
 
+    @locked_cached_property
+    def permission_table(self):
+
+        """
+        This users' effective permissions, as used by `Permission.check` and friends.
+
+        A dict with the keys 'own', mapping permission names to the access
+        assigned directly to this user and 'groups', mapping permission names
+        to OrderedDicts of access -> ids of this users' groups having it.
+
+        Compiled tables are shared across requests through app.permission_cache
+        and recompiled when `permission_version` moved since they were built.
+        """
+
+        version = permission_version()
+        cached = app.permission_cache.get(self.id)
+        if cached is not None and cached['version'] == version:
+            return cached['table']
+
+        table = self.compile_permissions()
+        app.permission_cache.set(self.id, {'version': version, 'table': table})
+
+        return table
+
+
+    def compile_permissions(self):
+
+        own_permissions = collections.OrderedDict()
+        for up in UserPermission.select().where(UserPermission.user == self):
+            own_permissions[up.permission] = up.access
+
+        group_permissions = collections.OrderedDict()
+        q = GroupPermission.select().join(UserGroup, on=(UserGroup.group == GroupPermission.group)).where(UserGroup.user == self).order_by(GroupPermission.group, GroupPermission.permission)
+        for gp in q:
+
+            if not gp.permission in group_permissions:
+                group_permissions[gp.permission] = collections.OrderedDict()
+
+            if not gp.access in group_permissions[gp.permission]:
+                group_permissions[gp.permission][gp.access] = []
+
+            group_permissions[gp.permission][gp.access].append(gp.group_id)
+
+        return {'own': own_permissions, 'groups': group_permissions}
+
+
+    @locked_cached_property
+    def permission_fingerprint(self):
+
+        """
+        Hashable summary of this users' effective permissions.
+        Users with the same fingerprint pass the same permission checks.
+        It's the full summary, not a hash of it, so different permissions
+        can't collide in cache keys.
+        """
+
+        own_permissions = self.permission_table['own']
+        own = tuple(sorted(own_permissions.items()))
+        groups = tuple(sorted([
+            (permission, tuple([(access, tuple(group_ids)) for access, group_ids in accesses.items()]))
+            for permission, accesses in self.permission_table['groups'].items()
+        ]))
+
+        # 'own' access modes compare instance owners against the user, so they make the result user-specific
+        if 'own' in own_permissions.values() or 'own_instance' in own_permissions.values():
+            identity = self.id
+        else:
+            identity = None
+
+        return (identity, own, groups)
+
+
+    def save(self, *args, **kwargs):
+
+        rv = super(User, self).save(*args, **kwargs)
+        self.evict_identity()
+
+        return rv
+
+
+    def delete_instance(self, *args, **kwargs):
+
+        rv = super(User, self).delete_instance(*args, **kwargs)
+        self.evict_identity()
+
+        return rv
+
+
+    def evict_identity(self):
+
+        """ Invalidate cached client certificate identities in all app processes, making the next request reload the user row. """
+
+        poobrains.helpers.bump_shared_version('identities')
+
+
     @classmethod
     def list(cls, op, user, handles=None, ordered=True, fields=[]):
 
@@ -1522,6 +1658,8 @@ class User(Named):
                 for (model_name, id) in info_sorted:
                     self.profile_posts.append(posts_by_model[model_name][id])
 
+                poobrains.storage.prefetch(self.profile_posts)
+
         return super(User, self).view(mode=mode, handle=handle, **kwargs)
 
 app.site.add_view(User, '/~<handle>/', mode='full', endpoint='user_profile')
@@ -1652,6 +1790,25 @@ class GroupPermission(Administerable):
         return "%s-%s" % (self.group.name, self.permission)
 
 
+@poobrains.storage.on_write
+def bump_permission_version(instance, op):
+
+    # deleting a Group or User takes their permission and membership rows with it
+    if isinstance(instance, (UserPermission, GroupPermission, UserGroup)) or (op == 'delete' and isinstance(instance, (Group, User))):
+
+        poobrains.helpers.bump_shared_version('permissions')
+
+
+def permission_version():
+
+    """
+    Token that changes whenever permission assignments or group memberships
+    change, in any app process.
+    """
+
+    return poobrains.helpers.shared_version('permissions')
+
+
 class ClientCertTokenAddForm(AutoForm):
 
     def process(self, submit, exceptions=False):
@@ -1743,7 +1900,25 @@ class ClientCert(Administerable):
             if self.__class__.select().where(self.__class__.user == self.user, self.__class__.name == self.name).count():
                 raise ValueError("User %s already has a client certificate named '%s'." % (self.user.name, self.name))
 
-        return super(ClientCert, self).save(force_insert=force_insert, only=only)
+        rv = super(ClientCert, self).save(force_insert=force_insert, only=only)
+        self.evict_identity()
+
+        return rv
+
+
+    def delete_instance(self, *args, **kwargs):
+
+        rv = super(ClientCert, self).delete_instance(*args, **kwargs)
+        self.evict_identity()
+
+        return rv
+
+
+    def evict_identity(self):
+
+        """ Invalidate the identity cache used by `Poobrain.request_setup`, in all app processes. """
+
+        poobrains.helpers.bump_shared_version('identities')
 
     
     @protected
@@ -1827,6 +2002,153 @@ class NamedOwned(Owned, Named):
         abstract = True
 
 
+@functools.lru_cache(maxsize=None) # the class hierarchy doesn't change after import
+def autocomplete_targets():
+
+    """
+    Protected Storables that StorableChoice form fields choose from, the
+    only classes the autocomplete endpoint serves. Serving just any Storable
+    would leak unprotected ones like Challenge.
+    """
+
+    targets = set()
+
+    choices = [poobrains.storage.fields.StorableChoice] # choice fields with a fixed storable, like TaggingField
+    while choices:
+        choice = choices.pop()
+        choices.extend(choice.__subclasses__())
+        if choice.storable is not None:
+            targets.add(choice.storable)
+
+    for cls in poobrains.storage.Model.class_children(): # foreign keys, chosen with ForeignKeyChoice
+        for field in cls._meta.sorted_fields:
+            if isinstance(field, peewee.ForeignKeyField) and isinstance(getattr(field, 'form_widget', None), type) and issubclass(field.form_widget, poobrains.storage.fields.StorableChoice):
+                targets.add(field.rel_model)
+
+    return frozenset([cls for cls in targets if issubclass(cls, poobrains.storage.Storable) and issubclass(cls, Protected)])
+
+
+@app.route('/autocomplete/<model>/')
+def autocomplete(model):
+
+    """
+    JSON list of [handle, title] pairs of `model` instances the current user
+    may read, whose autocomplete field starts with the request argument `q`.
+    Feeds the datalists of StorableChoice fields, see autocomplete_targets.
+    """
+
+    try:
+        cls = poobrains.storage.Storable.class_children_keyed()[model]
+    except KeyError:
+        flask.abort(404)
+
+    if not cls in autocomplete_targets():
+        flask.abort(404)
+
+    prefix = flask.request.args.get('q', '')
+    field = poobrains.storage.autocomplete_field(cls)
+
+    q = cls.list('read', flask.g.user, ordered=False)
+    if prefix:
+        # the range keeps the lookup on the fields' index, startswith makes it exact for any collation
+        q = q.where(field >= prefix, field < prefix + chr(0x10ffff), field.startswith(prefix))
+
+    q = q.order_by(field).limit(app.config['AUTOCOMPLETE_LIMIT'])
+
+    return flask.jsonify([[instance.handle_string, instance.title] for instance in q])
+
+
+def load_handles(rows, user):
+
+    """
+    The Administerables referenced by the model and handle attributes of
+    `rows`, in the same order. Ones `user` may not read are left out.
+    Costs one query per model.
+    """
+
+    administerables = Administerable.class_children_keyed()
+
+    instances = {}
+    for model_name, handles in poobrains.storage.group_handles([(row.model, row.handle) for row in rows]).items():
+
+        try:
+            cls = administerables[model_name]
+        except KeyError:
+            app.logger.error("Reference to unknown model: %s" % model_name)
+            continue
+
+        for instance in cls.list('read', user, handles=[cls.string_handle(handle) for handle in handles]):
+            instances[(model_name, instance.handle_string)] = instance
+
+    results = [instances[(row.model, row.handle)] for row in rows if (row.model, row.handle) in instances]
+    poobrains.storage.prefetch(results)
+
+    return results
+
+
+def reference_data(instance):
+
+    """
+    Column values pointing at `instance` from a model with model, handle,
+    date, owner, group and access columns, which `reference_predicate` can
+    filter by permissions. Like TagMembership and SearchDocument.
+    """
+
+    data = {
+        'model': instance.__class__.__name__,
+        'handle': instance.handle_string,
+        'date': None,
+        'owner': None,
+        'group': None,
+        'access': None
+    }
+
+    if isinstance(getattr(instance.__class__, 'date', None), peewee.DateTimeField):
+        data['date'] = instance.date
+
+    if isinstance(instance, Owned):
+        for name in ('owner', 'group', 'access'):
+            data[name] = instance.__data__.get(name) # __data__ so foreign keys give ids without loading rows
+
+    return data
+
+
+def reference_predicate(references, classes, user, op='read'):
+
+    """
+    SQL condition on `references`, a model with model, handle, owner, group
+    and access columns like TagMembership or SearchDocument, selecting the
+    rows pointing at instances of `classes` that `user` may `op`. Returns
+    None if there are none.
+
+    Classes overriding `list` filter beyond their permission predicate
+    (User and Group), which SQL here can't follow. They are left out, so
+    their rows aren't counted and paged, then dropped by `load_handles`.
+    """
+
+    clauses = []
+    for cls in classes:
+
+        if cls.list.__func__ is not Administerable.list.__func__:
+            continue
+
+        try:
+            predicate = cls.permissions[op].predicate(references, op, user)
+        except AccessDenied:
+            continue
+
+        clause = references.model == cls.__name__
+        if predicate is not True:
+            clause = clause & predicate
+
+        clauses.append(clause)
+
+    if not clauses:
+        return None
+
+    return functools.reduce(peewee.operator.or_, clauses)
+
+
 class Notification(poobrains.storage.Storable):
 
     to = poobrains.storage.fields.ForeignKeyField(User, related_name='notifications')
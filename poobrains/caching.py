@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+""" In-process caches shared across requests. """
+
+import time
+import threading
+import collections
+
+
+class LRUCache(object):
+
+    """
+    A thread-safe, size-bounded least-recently-used cache.
+
+    Entries can expire, either after the caches' default ``ttl`` or at an
+    explicit unix timestamp passed to ``set`` as ``expires``.
+    """
+
+    maxsize = None
+    ttl = None
+
+    def __init__(self, maxsize=1024, ttl=None):
+
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict() # key -> (expiry timestamp or None, value)
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return self._data.__len__()
+
+
+    def __contains__(self, key):
+        return self.get(key, default=self) is not self # self as sentinel, it's never a valid cached value
+
+
+    def get(self, key, default=None):
+
+        with self._lock:
+
+            try:
+                expiry, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expiry is not None and expiry <= time.time():
+                del(self._data[key])
+                return default
+
+            self._data.move_to_end(key) # mark as most recently used
+            return value
+
+
+    def set(self, key, value, ttl=None, expires=None):
+
+        """
+        Store `value` under `key`.
+
+        Parameters:
+        * ttl: Seconds this entry lives, overrides the caches' default ttl.
+        * expires: Unix timestamp after which this entry is dead. If given
+                   together with a ttl, whichever comes first wins.
+        """
+
+        if ttl is None:
+            ttl = self.ttl
+
+        expiry = None
+        if ttl is not None:
+            expiry = time.time() + ttl
+
+        if expires is not None and (expiry is None or expires < expiry):
+            expiry = expires
+
+        with self._lock:
+
+            self._data[key] = (expiry, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False) # drop least recently used
+
+
+    def delete(self, key):
+
+        with self._lock:
+            self._data.pop(key, None)
+
+
+    def evict(self, predicate):
+
+        """
+        Remove all entries for which ``predicate(key, value)`` is true.
+        Returns the number of removed entries.
+        """
+
+        with self._lock:
+
+            doomed = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+            for key in doomed:
+                del(self._data[key])
+
+        return len(doomed)
+
+
+    def clear(self):
+
+        with self._lock:
+            self._data.clear()
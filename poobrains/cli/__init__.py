@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
+import json
+import glob
 import datetime
 import functools
+import multiprocessing
 import codecs
 import peewee
 import OpenSSL
@@ -21,6 +25,10 @@ import poobrains.helpers
 import poobrains.storage
 import poobrains.auth
 import poobrains.svg
+import poobrains.search
+import poobrains.tagging
+import poobrains.commenting
+import poobrains.md
 
 from poobrains.form import types
 
@@ -90,6 +98,8 @@ def install(**options):
             #        app.db.create_tables([model])
 
             app.db.create_tables(poobrains.storage.Model.class_children())
+            poobrains.search.create_index()
+            poobrains.tagging.upgrade()
 
             echo("Database tables created!\n")
 
@@ -344,6 +354,178 @@ def cron():
     app.cron_run()
 
 
+@app.cli.command()
+def purge():
+
+    """ Purge the full-page cache of all running app processes. """
+
+    with app.app_context():
+
+        stamp_path = poobrains.helpers.page_cache_purge_path()
+        with open(stamp_path, 'a'):
+            os.utime(stamp_path, None) # bumps the purge stamp checked on every page cache hit
+
+    app.page_cache.clear()
+    echo("Page cache purged.")
+
+
+def reindex_checkpoint_path(cls, worker, workers):
+    return os.path.join(app.site_path, '.reindex', '%s-%d-of-%d.json' % (cls.__name__, worker, workers))
+
+
+def reindex_worker(cls, worker, workers, batch_size):
+
+    """
+    Rebuild derived data of every `workers`th row of cls, starting at `worker`.
+    Rows are walked in primary key order, in batches of batch_size. The last
+    key of each finished batch is written to a checkpoint file, so a
+    later run picks up where an interrupted one left off.
+    """
+
+    with app.app_context():
+
+        ordering = [field.asc() for field in cls._meta.get_primary_keys()] # total and never NULL, so fine for keyset paging
+        q = cls.select().order_by(*ordering)
+
+        if workers > 1:
+            pk = cls._meta.primary_key
+            q = q.where(pk - (pk / workers) * workers == worker) # pk modulo workers, '%' would need escaping for postgres drivers
+
+        checkpoint_path = reindex_checkpoint_path(cls, worker, workers)
+        last = None
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r') as checkpoint_file:
+                last = json.load(checkpoint_file)
+            echo("%s [%d/%d]: resuming after %s" % (cls.__name__, worker + 1, workers, last))
+
+        rows = 0
+        start = time.time()
+
+        while True:
+
+            batch_q = q
+            if last is not None:
+                batch_q = batch_q.where(cls.keyset_clause(ordering, last))
+
+            batch = [instance for instance in batch_q.limit(batch_size).iterator()]
+            if not batch:
+                break
+
+            with app.db.atomic():
+                for hook in poobrains.storage.reindex_hooks:
+                    hook(cls, batch)
+
+            last = batch[-1].keyset_values(ordering)
+            with open(checkpoint_path, 'w') as checkpoint_file:
+                json.dump(last, checkpoint_file, default=str)
+
+            rows += len(batch)
+            echo("%s [%d/%d]: %d rows, %.1f rows/s" % (cls.__name__, worker + 1, workers, rows, rows / max(time.time() - start, 0.001)))
+
+        if os.path.exists(checkpoint_path):
+            os.unlink(checkpoint_path) # done, next run starts from scratch
+
+        app.db.close()
+        return rows
+
+
+def reindex_task(args):
+
+    cls_name, worker, workers, batch_size = args # classes are looked up by name, so only strings are sent to worker processes
+    cls = poobrains.storage.Model.class_children_keyed()[cls_name]
+
+    return reindex_worker(cls, worker, workers, batch_size)
+
+
+@app.cli.command()
+@argument('storables', type=types.STORABLE, nargs=-1)
+@option('--batch-size', default=1000, help="Number of rows per batch and transaction")
+@option('--workers', default=1, help="Number of processes per class, only used for classes with an integer primary key")
+@option('--restart', is_flag=True, default=False, help="Ignore checkpoints of interrupted runs")
+def reindex(storables, batch_size, workers, restart):
+
+    """ Rebuild search index and other derived data, for all or the given storables. """
+
+    with app.app_context():
+
+        app.db.create_tables(poobrains.storage.Model.class_children()) # tables for derived data added since install
+        poobrains.search.create_index()
+        poobrains.tagging.upgrade()
+
+        checkpoint_dir = os.path.join(app.site_path, '.reindex')
+        if not os.path.exists(checkpoint_dir):
+            os.mkdir(checkpoint_dir)
+
+        if restart:
+            for checkpoint_path in glob.glob(os.path.join(checkpoint_dir, '*.json')):
+                os.unlink(checkpoint_path)
+
+    if not storables:
+        storables = sorted(poobrains.storage.Storable.class_children(), key=lambda cls: cls.__name__)
+
+    total_rows = 0
+    total_start = time.time()
+
+    for cls in storables:
+
+        start = time.time()
+        cls_workers = workers if isinstance(cls._meta.primary_key, peewee.IntegerField) else 1 # partitioning works by modulo of an integer key
+
+        if cls_workers > 1:
+
+            # forked processes must not share database connections
+            if app.db_pooled:
+                app.db.close_all()
+            else:
+                app.db.close()
+
+            with multiprocessing.get_context('fork').Pool(cls_workers) as pool:
+                rows = sum(pool.map(reindex_task, [(cls.__name__, worker, cls_workers, batch_size) for worker in range(0, cls_workers)]))
+
+        else:
+            rows = reindex_worker(cls, 0, 1, batch_size)
+
+        elapsed = max(time.time() - start, 0.001)
+        secho("Reindexed %d %s rows in %.1fs, %.1f rows/s." % (rows, cls.__name__, elapsed, rows / elapsed), fg='green')
+        total_rows += rows
+
+    elapsed = max(time.time() - total_start, 0.001)
+    secho("Reindexed %d rows in %.1fs, %.1f rows/s." % (total_rows, elapsed, total_rows / elapsed), fg='green')
+
+
+@app.cli.command()
+def recount():
+
+    """ Rebuild the comment counters of all Commentables, repairing any drift. """
+
+    with app.app_context():
+
+        app.db.create_tables([poobrains.commenting.CommentCount])
+        count = poobrains.commenting.recount()
+
+    echo("Counted comments of %d items." % count)
+
+
+@app.cli.command()
+@fake_before_request
+def rerender():
+
+    """ Render all markdown fields again, needed after changing MARKDOWN_CLASS or MARKDOWN_EXTENSIONS. """
+
+    app.db.create_tables([poobrains.md.RenderedMarkdown])
+    app.markdown_cache.clear()
+    count = 0
+
+    for text in poobrains.md.sources():
+        poobrains.md.store(text)
+        count += 1
+
+    echo("Rendered %d markdown fields." % count)
+
+    pruned = poobrains.md.prune()
+    echo("Dropped %d stale or orphaned renderings." % pruned)
+
+
 @app.cli.command(name='import')
 @argument('storable', type=types.STORABLE)
 @argument('filepath', type=types.Path(exists=True))
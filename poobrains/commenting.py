@@ -2,6 +2,9 @@
 
 import os
 import random
+import atexit
+import threading
+import concurrent.futures
 import functools
 import collections
 import datetime
@@ -27,6 +30,10 @@ class Comment(poobrains.auth.Administerable):
 
         abstract = False
         order_by = ['created']
+        fragment_cache = False # renders replies and reply forms
+        indexes = (
+            (('model', 'handle', 'created'), False), # whole threads are fetched by model and handle, in order of creation
+        )
 
     model = poobrains.storage.fields.CharField()
     handle = poobrains.storage.fields.CharField()
@@ -35,29 +42,109 @@ class Comment(poobrains.auth.Administerable):
     author = poobrains.storage.fields.CharField()
     text = poobrains.storage.fields.TextField()
 
+    _children = None # filled by build_threads
+    _commentable = None # the Commentable this comment belongs to, if already loaded
+    reply_count = None # number of replies, filled by CommentThread to tell which ones weren't loaded
+
+
+    @classmethod
+    def thread_query(cls, model, handle):
+
+        """ All comments on the Commentable of class name `model` with handle string `handle`, oldest first. """
+
+        poobrains.helpers.page_depends_on(cls)
+        return cls.select().where(cls.model == model, cls.handle == handle).order_by(cls.created, cls.id)
+
+
+    @staticmethod
+    def build_threads(comments):
+
+        """
+        Assemble `comments` into trees in one pass, without further queries.
+        Returns an OrderedDict of the comments without parent among them, each
+        mapped to an OrderedDict of its replies, and so on. Also fills the
+        children of each comment, for `child_comments`.
+        """
+
+        comments = list(comments)
+        nodes = collections.OrderedDict()
+
+        for comment in comments:
+            comment._children = []
+            nodes[comment.id] = (comment, collections.OrderedDict())
+
+        threads = collections.OrderedDict()
+        for comment, subtree in nodes.values():
+
+            if comment.reply_to_id in nodes:
+
+                parent, parent_subtree = nodes[comment.reply_to_id]
+                parent._children.append(comment)
+                parent_subtree[comment] = subtree
+
+            else:
+                threads[comment] = subtree
+
+        return threads
+
 
     def thread(self):
-        #TODO: Move creating trees into a stored procedure for performance at some point
-        thread = collections.OrderedDict()
 
-        children = Comment.select().where(Comment.reply_to == self)
+        """ Tree of all replies to this comment, see `build_threads`. """
+
+        threads = Comment.build_threads(Comment.thread_query(self.model, self.handle))
+
+        for comment, subtree in threads.items(): # find this comment in the trees
+            stack = [(comment, subtree)]
+            while stack:
+                current, current_subtree = stack.pop()
+                if current.id == self.id:
+                    self._children = current._children
+                    return current_subtree
+                stack.extend(current_subtree.items())
 
-        for child in children:
-            thread[child] = child.thread()
+        return collections.OrderedDict()
 
-        return thread
 
     def child_comments(self):
+
+        if self._children is not None:
+            return self._children
+
         return Comment.select().where(Comment.reply_to == self)
 
 
+    @property
+    def hidden_replies(self):
+
+        """ Number of replies that weren't loaded with this page of the thread. """
+
+        if self.reply_count is None:
+            return 0
+
+        return self.reply_count - len(self.child_comments())
+
+
+    def replies_url(self):
+
+        return flask.url_for('site.comment_replies', model=self.model, handle=self.handle, reply_to=self.id)
+
+
+    @property
+    def commentable(self):
+
+        if self._commentable is None:
+            self._commentable = Commentable.class_children_keyed()[self.model].load(self.handle)
+
+        return self._commentable
+
+
     def reply_form(self):
 
         children = Commentable.class_children_keyed()
         if self.model in children:
 
-            model = Commentable.class_children_keyed()[self.model]
-            comments_enabled = model.load(self.handle).comments_enabled
+            comments_enabled = self.commentable.comments_enabled
 
             if comments_enabled:
 
@@ -73,12 +160,79 @@ class Comment(poobrains.auth.Administerable):
         raise Exception("Bork")
 
 
+class CommentCount(poobrains.storage.Model):
+
+    """
+    Number of comments per Commentable, kept up to date by `count_comment`
+    so teasers don't need an aggregate query per item. Rebuilt by `recount`.
+    """
+
+    class Meta:
+        indexes = (
+            (('model', 'handle'), True),
+        )
+
+    model = poobrains.storage.fields.CharField(max_length=255)
+    handle = poobrains.storage.fields.CharField(max_length=255)
+    count = poobrains.storage.fields.IntegerField(default=0)
+
+
+@poobrains.storage.on_write
+def count_comment(instance, op):
+
+    if not isinstance(instance, Comment) or op == 'update':
+        return
+
+    if op == 'create':
+        CommentCount.insert(model=instance.model, handle=instance.handle, count=1).on_conflict(
+            conflict_target=[CommentCount.model, CommentCount.handle],
+            update={CommentCount.count: CommentCount.count + 1}
+        ).execute()
+
+    else: # delete
+        CommentCount.update(count=CommentCount.count - 1).where(CommentCount.model == instance.model, CommentCount.handle == instance.handle).execute()
+
+
+def recount():
+
+    """ Rebuild all CommentCounts from the comments themselves, returns the number of counted items. """
+
+    with app.db.atomic():
+
+        CommentCount.delete().execute()
+        counts = Comment.select(Comment.model, Comment.handle, peewee.fn.COUNT(Comment.id)).group_by(Comment.model, Comment.handle)
+        CommentCount.insert_from(counts, [CommentCount.model, CommentCount.handle, CommentCount.count]).execute()
+
+    return CommentCount.select().count()
+
+
+@poobrains.storage.on_prefetch
+def prefetch_comment_counts(instances):
+
+    """ Load the comment counts of all Commentables in `instances` with one query. """
+
+    commentables = [instance for instance in instances if isinstance(instance, Commentable) and instance._pk is not None]
+    if not commentables:
+        return
+
+    poobrains.helpers.page_depends_on(Comment)
+
+    clause = poobrains.storage.reference_clause(CommentCount, poobrains.storage.group_handles(poobrains.storage.instance_references(commentables)))
+    counts = dict([((model, handle), count) for model, handle, count in CommentCount.select(CommentCount.model, CommentCount.handle, CommentCount.count).where(clause).tuples()])
+
+    for instance in commentables:
+        instance._comment_count = counts.get((instance.__class__.__name__, instance.handle_string), 0)
+
+
 @poobrains.auth.User.on_profile
 class Commentable(poobrains.tagging.Taggable):
 
     class Meta:
         abstract = True
         order_by = ['-date']
+        fragment_cache = ['teaser', 'inline'] # full mode renders the comment thread
+
+    _comment_count = None # filled by prefetch_comment_counts
 
     comments_enabled = poobrains.storage.fields.BooleanField(default=True, verbose_name=u'Enable comments')
     notify_owner = poobrains.storage.fields.BooleanField(default=True, verbose_name='Notify owner', help_text='Whether to notify the owner of comments')
@@ -93,18 +247,32 @@ class Commentable(poobrains.tagging.Taggable):
     @property
     def comments(self):
         return Comment.select().where(Comment.model == self.__class__.__name__, Comment.handle == self.handle_string)
+
+
+    @property
+    def comment_count(self):
+
+        if self._comment_count is None:
+            prefetch_comment_counts([self])
+
+        return self._comment_count
     
 
     @property
     def comments_threaded(self):
 
+        """ Tree of all comments on this item, fetched with one query. """
+
         comments_threaded = collections.OrderedDict()
 
         try:
             Comment.permissions['read'].check(flask.g.user)
-            for comment in self.comments.where(Comment.reply_to == None): # iterate through root comments
-                comments_threaded[comment] = comment.thread()
 
+            comments = list(Comment.thread_query(self.__class__.__name__, self.handle_string))
+            for comment in comments:
+                comment._commentable = self # so reply forms don't load it again
+
+            comments_threaded = Comment.build_threads(comments)
 
         except poobrains.auth.AccessDenied:
             pass # No point loading shit this user isn't allowed to render anyways.
@@ -112,6 +280,18 @@ class Commentable(poobrains.tagging.Taggable):
         return comments_threaded
 
 
+    def comment_thread(self):
+
+        """ The current page of the comment thread, see `CommentThread`. """
+
+        try:
+            Comment.permissions['read'].check(flask.g.user)
+        except poobrains.auth.AccessDenied:
+            return None
+
+        return CommentThread(instance=self)
+
+
     def comment_form(self, reply_to=None):
 
         if self.comments_enabled:
@@ -126,6 +306,134 @@ class Commentable(poobrains.tagging.Taggable):
         return poobrains.rendering.RenderString("Commenting is disabled.")
 
 
+class CommentThread(poobrains.rendering.Renderable):
+
+    """
+    One page of the comments on a Commentable, or of the replies to one comment.
+
+    Pages hold up to COMMENT_PAGE_ROOTS top-level comments, paged by keyset
+    on their creation, along with their replies down to COMMENT_DEPTH levels
+    and COMMENT_PAGE_LIMIT comments in total. Comments with replies left out
+    link to a page of their own subtree, so page weight is bounded no matter
+    how big a thread grows.
+    """
+
+    instance = None # the Commentable
+    reply_to = None # Comment whose replies are shown, None for the whole thread
+    threads = None
+    next_url = None
+
+    def __init__(self, model=None, handle=None, instance=None, reply_to=None, **kwargs):
+
+        super(CommentThread, self).__init__()
+
+        if not isinstance(instance, Commentable):
+
+            try:
+                cls = Commentable.class_children_keyed()[model]
+            except KeyError:
+                flask.abort(404)
+
+            instance = cls.load(handle)
+
+        if isinstance(reply_to, int):
+            reply_to = Comment.load(reply_to)
+
+        if reply_to is not None and (reply_to.model != instance.__class__.__name__ or reply_to.handle != instance.handle_string):
+            flask.abort(404) # a comment on something else
+
+        self.instance = instance
+        self.reply_to = reply_to
+
+
+    @property
+    def title(self):
+
+        if self.reply_to:
+            return "Replies to %s on %s" % (self.reply_to.author, self.instance.title)
+
+        return "Comments on %s" % self.instance.title
+
+
+    def load(self, after=None):
+
+        """ Fetch the comments of this page, the top-level ones coming after the comment with id `after`. """
+
+        model = self.instance.__class__.__name__
+        handle = self.instance.handle_string
+        thread = Comment.thread_query(model, handle)
+
+        if self.reply_to:
+            level_query = thread.where(Comment.reply_to == self.reply_to)
+        else:
+            level_query = thread.where(Comment.reply_to.is_null())
+
+        if after:
+            try:
+                last = Comment.get_by_id(after)
+                level_query = level_query.where(Comment.keyset_clause(Comment.keyset_ordering(), [last.created, last.id]))
+            except Comment.DoesNotExist:
+                pass # deleted since, start over
+
+        level = list(level_query.limit(app.config['COMMENT_PAGE_ROOTS'] + 1)) # one more to know whether there's a next page
+        if len(level) > app.config['COMMENT_PAGE_ROOTS']:
+            level = level[:app.config['COMMENT_PAGE_ROOTS']]
+            self.next_url = "%s?comments_after=%d" % (self.page_url(), level[-1].id)
+
+        comments = list(level)
+        budget = app.config['COMMENT_PAGE_LIMIT'] - len(comments)
+
+        for depth in range(1, app.config['COMMENT_DEPTH']): # one query per level
+
+            if not level or budget <= 0:
+                break
+
+            level = list(thread.where(Comment.reply_to.in_([comment.id for comment in level])).limit(budget))
+            comments.extend(level)
+            budget -= len(level)
+
+        reply_counts = {}
+        if comments:
+            reply_counts = dict(Comment.select(Comment.reply_to, peewee.fn.COUNT(Comment.id)).where(Comment.reply_to.in_([comment.id for comment in comments])).group_by(Comment.reply_to).tuples())
+
+        for comment in comments:
+            comment._commentable = self.instance
+            comment.reply_count = reply_counts.get(comment.id, 0)
+
+        self.threads = Comment.build_threads(comments)
+
+        if self.reply_to:
+            self.reply_to._commentable = self.instance
+            self.reply_to._children = list(self.threads.keys())
+
+
+    def page_url(self):
+
+        if self.reply_to:
+            return self.reply_to.replies_url()
+
+        return self.instance.url('full')
+
+
+    @poobrains.helpers.themed
+    def view(self, mode='full', **kwargs):
+
+        Comment.permissions['read'].check(flask.g.user)
+        self.instance.permissions['read'].check(flask.g.user)
+
+        return self
+
+
+    def render(self, mode='full'):
+
+        if self.threads is None: # not loaded yet
+            self.load(after=flask.request.args.get('comments_after', type=int))
+
+        return super(CommentThread, self).render(mode)
+
+app.site.add_view(CommentThread, '/comment/<string:model>/<string:handle>/replies/<int:reply_to>', mode='full', endpoint='comment_replies')
+
+
 @app.expose('/comment/<string:model>/<string:handle>')
 @app.expose('/comment/<string:model>/<string:handle>/<int:reply_to>')
 class CommentForm(poobrains.form.Form):
@@ -173,6 +481,7 @@ class CommentForm(poobrains.form.Form):
 
         challenge = Challenge()
         challenge.name = name
+        challenge.captcha = issue_captcha()
         challenge.model = self.instance.__class__.__name__
         challenge.handle = self.instance.handle_string
         challenge.reply_to = self.fields['reply_to'].value
@@ -184,92 +493,235 @@ class CommentForm(poobrains.form.Form):
         return flask.redirect(challenge.url('full'))
 
 
-class Challenge(poobrains.storage.Named):
+fonts = {} # (path, size) -> loaded font, see captcha_font
 
 
-    class Meta:
+def captcha_font(size=42):
 
-        modes = collections.OrderedDict([('full', 'read'), ('raw', 'read')])
+    """ The captcha font, loaded once per process. """
 
+    path = os.path.join(app.poobrain_path, 'themes/default/fonts/knewave/knewave-outline.otf')
 
-    title = 'Fuck bots, get bugs'
-    captcha = poobrains.storage.fields.CharField(default=functools.partial(poobrains.helpers.random_string_light, 6))
-    model = poobrains.storage.fields.CharField()
-    handle = poobrains.storage.fields.CharField()
-    reply_to = poobrains.storage.fields.ForeignKeyField(Comment, null=True)
-    created = poobrains.storage.fields.DateTimeField(default=datetime.datetime.now, null=False)
-    author = poobrains.storage.fields.CharField()
-    text = poobrains.storage.fields.TextField()
+    if not (path, size) in fonts:
+        fonts[(path, size)] = ImageFont.truetype(path, size)
 
+    return fonts[(path, size)]
 
-    def view(self, mode=None, handle=None):
 
-        """
-        view function to be called in a flask request context
-        """
+def render_captcha(captcha):
 
-        if mode == 'raw':
+    """ Render `captcha` into a PNG image, returns its bytes. """
+
+    colors = [
+        (0,128,255),
+        (0,255,128),
+        (128,0,255),
+        (128,255,0),
+        (255,0,128),
+        (255,128,0)
+    ]
+
+    image = Image.new('RGBA', (250, 80), (255,255,255,0))
+    font = captcha_font()
+
+
+    #x_jitter = ((image.width/10) * -1, 0)
+    #y_jitter = ((image.height/10) * -1, image.height/10)
+    x_jitter = (-5, 5)
+    y_jitter = (-5, 5)
+
+    textsize = font.getsize(' '.join(captcha))
+    centered = (image.width / 2 - textsize[0] / 2, image.height / 2 - textsize[1] / 2)
+
+    x = centered[0] + random.randint(x_jitter[0], x_jitter[1])
+    y = centered[1] + random.randint(y_jitter[0], y_jitter[1])
+    baseline = centered[1]
+
+    for char in captcha:
+
+        c = colors[random.randint(0, len(colors) -1)]
+        c = tuple(list(c) + [random.randint(255,255)])
+
+
+        char_size = font.getsize(char)
+
+        char_wrapped = ' %s ' % char
+        char_wrapped_size = font.getsize(char_wrapped)
+
+        char_layer = Image.new('RGBA', char_wrapped_size, (0,0,0,0))
+        char_draw = ImageDraw.Draw(char_layer)
+
+        char_draw.text((0,0), char_wrapped, c, font=font)
+        char_layer = char_layer.rotate(random.randint(-15, 15), expand=True, resample=Image.BICUBIC)
+
+        image.paste(
+            char_layer,
+            (x, y),
+            mask=char_layer,
+        )
+
+        x += char_size[0] + random.randint(x_jitter[0], x_jitter[1])
+        y = baseline + random.randint(y_jitter[0], y_jitter[1])
+
+    shine = image.filter(ImageFilter.GaussianBlur(radius=8))
+    image = Image.alpha_composite(image, shine)
+
+    out = io.BytesIO()
+    image.save(out, format='PNG')
+
+    return out.getvalue()
+
+
+def render_random_captcha(length):
+
+    captcha = poobrains.helpers.random_string_light(length)
+    return captcha, render_captcha(captcha)
+
+
+class CaptchaPool(object):
+
+    """
+    Captchas rendered ahead of time, as (captcha, png) pairs.
+    Taking one queues a refill, which is rendered by a thread pool in the
+    background, so requests don't have to wait for Pillow. Threads, because
+    forking worker processes from a threaded server can deadlock on locks
+    held by other threads. Pillow releases the GIL for the heavy parts.
+    """
+
+    pairs = None
+    pending = None
+    executor = None
+    pid = None # process the executor was started in, its threads don't survive forks of worker processes
 
-            colors = [
-                (0,128,255),
-                (0,255,128),
-                (128,0,255),
-                (128,255,0),
-                (255,0,128),
-                (255,128,0)
-            ]
+    def __init__(self):
 
-            font_path = os.path.join(app.poobrain_path, 'themes/default/fonts/knewave/knewave-outline.otf')
-            image = Image.new('RGBA', (250, 80), (255,255,255,0))
-            font = ImageFont.truetype(font_path, 42)
+        super(CaptchaPool, self).__init__()
+        self.pairs = collections.deque()
+        self.pending = []
+        self.lock = threading.Lock()
 
 
-            #x_jitter = ((image.width/10) * -1, 0)
-            #y_jitter = ((image.height/10) * -1, image.height/10)
-            x_jitter = (-5, 5)
-            y_jitter = (-5, 5)
+    def take(self):
 
-            textsize = font.getsize(' '.join(self.captcha))
-            centered = (image.width / 2 - textsize[0] / 2, image.height / 2 - textsize[1] / 2)
+        """ A ready (captcha, png) pair, or None if there is none right now. """
 
-            x = centered[0] + random.randint(x_jitter[0], x_jitter[1])
-            y = centered[1] + random.randint(y_jitter[0], y_jitter[1])
-            baseline = centered[1]
+        if not app.config['CAPTCHA_POOL_SIZE']:
+            return None
 
-            for char in self.captcha:
+        with self.lock:
 
-                c = colors[random.randint(0, len(colors) -1)]
-                c = tuple(list(c) + [random.randint(255,255)])
+            self.collect()
 
+            try:
+                pair = self.pairs.popleft()
+            except IndexError:
+                pair = None
+
+            self.refill()
+
+        return pair
+
+
+    def collect(self):
+
+        for future in [future for future in self.pending if future.done()]:
+
+            self.pending.remove(future)
+
+            try:
+                self.pairs.append(future.result())
+            except Exception as e:
+                app.logger.error("Failed rendering captcha: %s" % e)
+
+
+    def refill(self):
+
+        missing = app.config['CAPTCHA_POOL_SIZE'] - len(self.pairs) - len(self.pending)
+        if missing <= 0:
+            return
+
+        if self.executor is None or self.pid != os.getpid():
+
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=app.config['CAPTCHA_POOL_WORKERS'],
+                thread_name_prefix='captcha'
+            )
+            self.pid = os.getpid()
+            self.pending = []
 
-                char_size = font.getsize(char)
+        length = len(Challenge.captcha.default())
+        for i in range(0, missing):
+            self.pending.append(self.executor.submit(render_random_captcha, length))
 
-                char_wrapped = ' %s ' % char
-                char_wrapped_size = font.getsize(char_wrapped)
 
-                char_layer = Image.new('RGBA', char_wrapped_size, (0,0,0,0))
-                char_draw = ImageDraw.Draw(char_layer)
+    def shutdown(self):
 
-                char_draw.text((0,0), char_wrapped, c, font=font)
-                char_layer = char_layer.rotate(random.randint(-15, 15), expand=True, resample=Image.BICUBIC)
+        """ Stop rendering, dropping queued captchas. Called on exit. """
 
-                image.paste(
-                    char_layer,
-                    (x, y),
-                    mask=char_layer,
-                )
+        with self.lock:
 
-                x += char_size[0] + random.randint(x_jitter[0], x_jitter[1])
-                y = baseline + random.randint(y_jitter[0], y_jitter[1])
+            if self.executor is not None and self.pid == os.getpid():
 
-            shine = image.filter(ImageFilter.GaussianBlur(radius=8))
-            image = Image.alpha_composite(image, shine)
+                for future in self.pending:
+                    future.cancel() # only cancels captchas not being rendered yet
 
-            out = io.BytesIO()
-            image.save(out, format='PNG')
+                self.executor.shutdown(wait=True)
+
+            self.executor = None
+            self.pending = []
+
+
+captcha_pool = CaptchaPool()
+atexit.register(captcha_pool.shutdown)
+
+
+def issue_captcha():
+
+    """ A new captcha for a Challenge, with its image already rendered if the pool has one ready. """
+
+    pair = captcha_pool.take()
+    if pair is None:
+        return Challenge.captcha.default()
+
+    captcha, png = pair
+    app.captcha_cache.set(captcha, png)
+
+    return captcha
+
+
+class Challenge(poobrains.storage.Named):
+
+
+    class Meta:
+
+        modes = collections.OrderedDict([('full', 'read'), ('raw', 'read')])
+
+
+    title = 'Fuck bots, get bugs'
+    captcha = poobrains.storage.fields.CharField(default=functools.partial(poobrains.helpers.random_string_light, 6))
+    model = poobrains.storage.fields.CharField()
+    handle = poobrains.storage.fields.CharField()
+    reply_to = poobrains.storage.fields.ForeignKeyField(Comment, null=True)
+    created = poobrains.storage.fields.DateTimeField(default=datetime.datetime.now, null=False)
+    author = poobrains.storage.fields.CharField()
+    text = poobrains.storage.fields.TextField()
+
+
+    def view(self, mode=None, handle=None):
+
+        """
+        view function to be called in a flask request context
+        """
+
+        if mode == 'raw':
+
+            png = app.captcha_cache.get(self.captcha)
+            if png is None:
+                png = render_captcha(self.captcha)
+                app.captcha_cache.set(self.captcha, png)
 
             return flask.Response(
-                out.getvalue(),
+                png,
                 mimetype='image/png'
             )
 
@@ -294,7 +746,7 @@ class ChallengeForm(poobrains.form.Form):
     def validate(self):
         
         if not self.fields['response'].value == self.challenge.captcha:
-            self.challenge.captcha = self.challenge.__class__.captcha.default()
+            self.challenge.captcha = issue_captcha()
             self.challenge.save()
             raise poobrains.errors.ValidationError("A robot could do this better and cheaper than you.")
 
@@ -322,18 +774,30 @@ class ChallengeForm(poobrains.form.Form):
         comment.author = self.challenge.author
         comment.text = self.challenge.text
 
-        if comment.save():
+        with app.db.atomic(): # comment, its count and the challenge go together
+
+            saved = comment.save()
+            if saved:
+                self.challenge.delete_instance() # commit glorious seppuku
+
+        if saved:
             flask.flash(u"Your comment has been saved.")
 
             if instance.notify_owner:
                 instance.owner.notify("New comment on [%s/%s] by %s." % (self.challenge.model, self.challenge.handle, self.challenge.author))
             
-            self.challenge.delete_instance() # commit glorious seppuku
             return flask.redirect(instance.url('full'))
 
         flask.flash(u"Your comment could not be saved.", 'error')
 
 
+@poobrains.storage.on_write
+def invalidate_commented_fragments(instance, op):
+
+    if isinstance(instance, Comment):
+        poobrains.storage.evict_fragments(instance.model)
+
+
 @app.cron
 def bury_orphaned_challenges():
 
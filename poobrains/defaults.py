@@ -10,6 +10,22 @@ SITE_NAME = 'poobrains'
 LOGFILE = False # examples: 'poobrains.log', '/var/log/poobrains.log' TODO: is this really needed with nginx logging?
 THEME = 'default'
 PAGINATION_COUNT = 10
+PAGINATION_KEYSET = True # page through listings by last seen sort key instead of only by offset
+PAGINATION_WINDOW = 3 # number of pages linked on either side of the current one, first and last page are always linked
+PAGINATION_APPROXIMATE_COUNT = False # postgres only: use the planners' row estimate for queries estimated to yield at least this many rows
+
+SEARCH_FULLTEXT = True # use the full-text index for search, False falls back to LIKE matching (slow, but needs no index)
+SEARCH_LANGUAGE = 'simple' # postgres text search configuration used for the search index
+
+COMMENT_PAGE_ROOTS = 20 # top-level comments per page of a comment thread
+COMMENT_DEPTH = 3 # levels of comments rendered per page, deeper replies are behind a link to their subtree
+COMMENT_PAGE_LIMIT = 200 # max number of comments rendered on one page, no matter the shape of the thread
+
+CAPTCHA_CACHE_SIZE = 1024 # max number of rendered captcha images kept in memory
+CAPTCHA_POOL_SIZE = 32 # number of captchas rendered ahead of time per process, 0 renders them on request only
+CAPTCHA_POOL_WORKERS = 2 # number of threads per process rendering captchas for the pool
+
+AUTOCOMPLETE_LIMIT = 20 # max number of suggestions returned by the autocomplete endpoint
 
 TOKEN_VALIDITY = 600
 MAX_TOKENS = 5 # maximum number of allowed clientcert tokens for a single user
@@ -33,6 +49,11 @@ SMTP_ACCOUNT = None # str
 SMTP_PASSWORD = None # str
 SMTP_FROM = None
 
+# only used with pooled DATABASE urls (i.e. postgres+pool://, sqlite+pool://), can be overridden by url parameters
+DATABASE_POOL_MAX_CONNECTIONS = 20 # int, 0 means unlimited
+DATABASE_POOL_STALE_TIMEOUT = 300 # seconds after which an idle connection is recycled
+DATABASE_POOL_TIMEOUT = 10 # seconds to wait for a free connection when max_connections is reached
+
 CRYPTO_KEYLENGTH = 4096
 
 GPG_BINARY = None
@@ -43,5 +64,23 @@ GPG_PASSPHRASE = None # str, gpg key passphrase for signing
 CACHE_SHORT = 60 * 15 # 15 minutes
 CACHE_LONG = 60 * 60 * 24 * 7 # a week
 
+IDENTITY_CACHE_SIZE = 1024 # max number of client certificates whose user is kept in memory
+IDENTITY_CACHE_TTL = CACHE_SHORT
+
+PAGE_CACHE = False # whether to cache fully rendered pages for the anonymous user
+PAGE_CACHE_SIZE = 1024 # max number of cached pages
+
+FRAGMENT_CACHE_SIZE = 4096 # max number of rendered Storables kept in memory
+
+BOX_CACHE_SIZE = 1024 # max number of boxes with 'user' or 'global' cache policy kept in memory
+
+COUNT_CACHE_SIZE = 4096 # max number of cached pagination counts
+COUNT_CACHE_TTL = 60 # bounds how long other processes can show outdated counts
+
+PERMISSION_CACHE_SIZE = 1024 # max number of users whose compiled permissions are kept in memory
+PERMISSION_CACHE_TTL = CACHE_SHORT # bounds how long other processes can lag behind permission changes
+
+MARKDOWN_CACHE_SIZE = 4096 # max number of rendered markdown strings kept in memory, on top of the ones stored in the database
+
 MARKDOWN_CLASS = md_default.pooMarkdown
 MARKDOWN_EXTENSIONS = ['markdown.extensions.codehilite', 'markdown.extensions.fenced_code', 'markdown.extensions.tables']
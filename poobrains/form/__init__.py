@@ -501,3 +501,7 @@ class Button(poobrains.rendering.Renderable):
     def templates(self, mode=None):
 
         return ['form/button-%s.jinja' % self.type, 'form/button.jinja']
+
+
+    def template_cache_key(self, mode=None):
+        return (self.__class__, mode, self.type)
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
 import string
 import random
+import tempfile
+import types
 import functools
 import codecs # so we can open a file as utf-8 in order to parse ASV for importing data
+import collections.abc
 import werkzeug
 import peewee
 import flask
@@ -85,10 +90,182 @@ def clean_string(s):
     return clean
 
 
+def page_cache_key():
+
+    """
+    Return the key of the current request in the full-page cache, or None if
+    the request has to bypass it. Only GET requests by the anonymous user
+    without pending flashed messages are cached, and only if PAGE_CACHE is on.
+    """
+
+    app = flask.current_app
+
+    if not app.config['PAGE_CACHE'] or flask.request.method != 'GET':
+        return None
+
+    user = getattr(flask.g, 'user', None)
+    if user is None or user.id != 1: # not "anonymous"
+        return None
+
+    if flask.session.get('_flashes'):
+        return None
+
+    return (flask.request.path, app.config['THEME'], flask.request.query_string)
+
+
+def page_cache_get(key):
+
+    page = flask.current_app.page_cache.get(key)
+
+    if page is not None and page['created'] > page_cache_purged() and versions_current(page['versions']):
+        return page['body'], page['status_code']
+
+    return None
+
+
+def page_cache_set(key, body, status_code):
+
+    """ Store a rendered page unless rendering it had side effects that must not be skipped. """
+
+    if status_code != 200 or flask.session.get('_flashes') or flask.session.modified:
+        return
+
+    classes = getattr(flask.g, 'rendered_classes', set())
+
+    flask.current_app.page_cache.set(key, {
+        'created': time.time(),
+        'body': body,
+        'status_code': status_code,
+        'versions': class_versions(classes) # of the classes that went into this page, writes to them in any process make it stale
+    })
+
+
+def page_depends_on(*classes):
+
+    """
+    Record that the page being rendered shows rows of `classes`, so writes to
+    them drop it from the full-page cache. Needed for everything that's
+    queried, not only what's rendered: an empty listing renders no instance
+    of its class, but must go stale once there is one.
+    """
+
+    if flask.has_request_context() and hasattr(flask.g, 'rendered_classes'):
+        flask.g.rendered_classes.update(classes)
+
+
+def page_cache_purge_path():
+    return os.path.join(flask.current_app.site_path, '.page_cache_purged')
+
+
+def page_cache_purged():
+
+    """ Time of the last `purge` CLI run, which can't reach the memory of running app processes directly. """
+
+    try:
+        return os.stat(page_cache_purge_path()).st_mtime
+    except OSError:
+        return 0
+
+
+def shared_version_path(name):
+    return os.path.join(flask.current_app.site_path, '.versions', name)
+
+
+def shared_version(name):
+
+    """
+    Token that changes whenever `name` is bumped, see `bump_shared_version`.
+    Kept in a file, so a write handled by one app process can invalidate
+    what all others have cached in memory. Read once per request.
+    """
+
+    versions = flask.g.setdefault('shared_versions', {}) if flask.has_request_context() else {}
+
+    if not name in versions:
+
+        try:
+            with open(shared_version_path(name)) as version_file:
+                versions[name] = version_file.read()
+
+        except OSError:
+            versions[name] = ''
+
+    return versions[name]
+
+
+def bump_shared_version(name):
+
+    path = shared_version_path(name)
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    version = random_string_light(32)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory) # unique per call, concurrent bumps can't replace each others' file
+    try:
+        with os.fdopen(fd, 'w') as version_file:
+            version_file.write(version)
+        os.replace(tmp_path, path) # atomic, readers see either the old or the new version
+
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    if flask.has_request_context():
+        flask.g.setdefault('shared_versions', {})[name] = version
+
+
+def class_version_name(cls):
+    return 'class-%s' % cls.__name__
+
+
+def class_versions(classes):
+
+    """
+    Shared versions of the model classes among `classes` and of permissions,
+    for output built from them. See `storage.bump_class_versions`.
+    """
+
+    names = set([class_version_name(cls) for cls in classes if isinstance(cls, peewee.ModelBase)])
+    names.add('permissions')
+
+    return dict([(name, shared_version(name)) for name in names])
+
+
+def versions_current(versions):
+
+    """ Whether none of the shared `versions` were bumped since they were read. """
+
+    for name, version in versions.items():
+        if shared_version(name) != version:
+            return False
+
+    return True
+
+
 def themed(f):
 
     @functools.wraps(f)
     def real(*args, **kwargs):
+
+        cache_key = None
+        outermost = not hasattr(flask.g, 'page_cache_key') # nested themed calls (i.e. forms in Administerable.view) leave caching to the outermost one
+
+        if outermost:
+
+            cache_key = page_cache_key()
+            flask.g.page_cache_key = cache_key
+
+            if cache_key is not None:
+
+                cached = page_cache_get(cache_key)
+                if cached is not None:
+                    return cached
+
+                flask.g.rendered_classes = set()
         
         rv = f(*args, **kwargs)
 
@@ -105,7 +282,11 @@ def themed(f):
             return rv # pass Responses (i.e. redirects) upwards
 
         elif isinstance(content, ThemedPassthrough):
-            return rv.themed
+
+            if cache_key is not None and isinstance(content.themed, tuple):
+                page_cache_set(cache_key, *content.themed)
+
+            return content.themed
 
 
         if hasattr(content, '_title') and content._title:
@@ -132,7 +313,12 @@ def themed(f):
             #mode = content._meta.modes.keys()[0] # TODO: Default mode option in _meta?
             mode = 'full' # will use default value for kwarg in .view
 
-        return flask.render_template('main.jinja', content=content, mode=mode, user=user), status_code
+        body = flask.render_template('main.jinja', content=content, mode=mode, user=user)
+
+        if cache_key is not None:
+            page_cache_set(cache_key, body, status_code)
+
+        return body, status_code
 
     return real
 
@@ -182,6 +368,75 @@ class ThemedPassthrough(object):
         self.themed = themed
 
 
+class LazyBoxes(collections.abc.Mapping):
+
+    """
+    Mapping of box names to box content, used as `flask.g.boxes`.
+
+    Box functions are only called when a template first accesses their box,
+    so responses that never render main.jinja (redirects, raw/JSON output)
+    don't pay for them. Each box is run at most once per request; boxes with
+    a 'user' or 'global' cache policy are additionally kept in `cache` across
+    requests.
+    """
+
+    policies = ('request', 'user', 'global')
+
+    cache = None
+
+    def __init__(self, cache=None):
+
+        super(LazyBoxes, self).__init__()
+        self.cache = cache
+        self._boxes = OrderedDict() # name -> (function, policy, ttl)
+        self._values = {}
+
+
+    def register(self, name, f, cache='request', ttl=None):
+
+        if not cache in self.policies:
+            raise ValueError("Unknown cache policy '%s' for box '%s'." % (cache, name))
+
+        self._boxes[name] = (f, cache, ttl)
+        self._values.pop(name, None) # a box registered later (i.e. by a blueprint) replaces the earlier one
+
+
+    def __getitem__(self, name):
+
+        if name in self._values:
+            return self._values[name]
+
+        f, policy, ttl = self._boxes[name] # raises KeyError for unknown boxes, which jinja turns into Undefined
+
+        if policy == 'request' or self.cache is None:
+            value = f()
+
+        else:
+
+            # keyed by function, not name, because blueprints can register different boxes under the same name
+            if policy == 'user':
+                user = getattr(flask.g, 'user', None)
+                key = (f, user.id if user else None)
+            else: # global
+                key = (f,)
+
+            value = self.cache.get(key, default=self)
+            if value is self: # self is the miss sentinel, it's never a valid box value
+                value = f()
+                self.cache.set(key, value, ttl=ttl)
+
+        self._values[name] = value
+        return value
+
+
+    def __iter__(self):
+        return self._boxes.__iter__()
+
+
+    def __len__(self):
+        return self._boxes.__len__()
+
+
 class ClassOrInstanceBound(type): # probably the worst name I ever picked, but hey it's descriptive! ¯\_(ツ)_/¯
 
     def __get__(self, instance, owner):
@@ -209,6 +464,61 @@ class FakeMetaOptions(object):
         self._additional_keys = set([])
 
 
+class ClassRegistry(object):
+
+    """
+    Index of all classes created through `MetaCompatibility`, by ancestor.
+
+    Every new class is added to the entries of all its registered ancestors
+    the moment it is defined, so `ChildAware.class_children` and
+    `ChildAware.class_children_keyed` are plain lookups instead of walks
+    through `__subclasses__`.
+    """
+
+    def __init__(self):
+
+        super(ClassRegistry, self).__init__()
+        self._entries = {}
+
+
+    def entry(self, cls):
+
+        try:
+            return self._entries[cls]
+
+        except KeyError:
+            entry = {
+                'all': set(), # including abstract children
+                'concrete': set(),
+                'keyed': OrderedDict(),
+                'keyed_lower': OrderedDict(),
+            }
+            self._entries[cls] = entry
+            return entry
+
+
+    def register(self, cls):
+
+        self.entry(cls)
+        concrete = not getattr(cls._meta, 'abstract', False)
+
+        for ancestor in cls.__mro__[1:]:
+
+            if ancestor not in self._entries:
+                continue # not created through MetaCompatibility
+
+            entry = self._entries[ancestor]
+            entry['all'].add(cls)
+
+            if concrete:
+                entry['concrete'].add(cls)
+                entry['keyed'][cls.__name__] = cls
+                entry['keyed_lower'][cls.__name__.lower()] = cls
+
+
+class_registry = ClassRegistry()
+
+
 class MetaCompatibility(type):
 
     """
@@ -258,6 +568,8 @@ class MetaCompatibility(type):
             if not hasattr(cls._meta, 'handle_fields'):
                 cls._meta.handle_fields = [field.name for field in cls._meta.get_primary_keys()]
 
+        class_registry.register(cls)
+
         return cls
 
 
@@ -268,29 +580,15 @@ class ChildAware(object, metaclass=MetaCompatibility):
     @classmethod
     def class_children(cls, abstract=False):
 
-        reported_children = set()
-        children = cls.__subclasses__()
-
-        for child in children:
-
-            if abstract or not hasattr(child._meta, 'abstract') or not child._meta.abstract:
-                reported_children.add(child)
-
-            reported_children = reported_children.union(child.class_children())
-
-        return reported_children
+        entry = class_registry.entry(cls)
+        return frozenset(entry['all'] if abstract else entry['concrete'])
 
 
     @classmethod
     def class_children_keyed(cls, lower=False):
 
-        children_keyed = OrderedDict()
-
-        for child in cls.class_children():
-            key = child.__name__.lower() if lower else child.__name__
-            children_keyed[key] = child
-
-        return children_keyed
+        entry = class_registry.entry(cls)
+        return types.MappingProxyType(entry['keyed_lower'] if lower else entry['keyed'])
 
 
     @classmethod
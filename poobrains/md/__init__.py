@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import threading
 import collections
 import peewee
 import jinja2
@@ -9,17 +11,23 @@ import flask
 
 # local imports
 from poobrains import app
+import poobrains.helpers
 import poobrains.rendering
 import poobrains.storage
 #import poobrains.auth
 
 
+conversion = threading.local() # state of the conversion running in this thread, see convert
+
+
 def magic_markdown_loader(storable, handle):
 
+    conversion.dynamic = True # output depends on the referenced instance
     storables = poobrains.storage.Storable.class_children_keyed(lower=True)
 
     if storable.lower() in storables:
         cls = storables[storable.lower()]
+        poobrains.helpers.page_depends_on(cls) # cached fragments and pages with this reference go stale with it
         return cls.load(handle)
 
     else:
@@ -30,10 +38,176 @@ def magic_markdown_loader(storable, handle):
     return False
 
 
+class RenderedMarkdown(poobrains.storage.Model):
+
+    """
+    HTML rendered from markdown, keyed by a hash of the source. Rows rendered
+    with another markdown configuration than the current one are stale, see
+    `config_hash`. Markdown that embeds or references other instances is
+    never stored, as its HTML depends on them and on the viewing user.
+    Rows are written when markdown is saved, see `store`, never when it's
+    viewed. Stale and orphaned rows are removed by `prune`.
+    """
+
+    hash = poobrains.storage.fields.CharField(max_length=64, unique=True)
+    config = poobrains.storage.fields.CharField(max_length=64)
+    html = poobrains.storage.fields.TextField()
+
+
+def config_hash():
+
+    """ Hash of MARKDOWN_CLASS and MARKDOWN_EXTENSIONS. """
+
+    cls = app.config['MARKDOWN_CLASS']
+    parts = ['%s.%s' % (cls.__module__, cls.__name__)]
+
+    for extension in app.config['MARKDOWN_EXTENSIONS']:
+
+        if isinstance(extension, str):
+            parts.append(extension)
+        else:
+            parts.append('%s.%s' % (extension.__class__.__module__, extension.__class__.__name__))
+
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def text_hash(text):
+
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def convert(text):
+
+    """ Convert markdown `text`, returns (html, dynamic), dynamic being whether the HTML depends on anything but `text`. """
+
+    outer_dynamic = getattr(conversion, 'dynamic', False) # conversions nest when embedded instances render markdown of their own
+    conversion.dynamic = False
+
+    try:
+        html = md.convert(text)
+        dynamic = conversion.dynamic
+    finally:
+        conversion.dynamic = outer_dynamic
+
+    return html, dynamic
+
+
+def render(text):
+
+    """
+    HTML for markdown `text`. Looked up in app.markdown_cache, then in
+    RenderedMarkdown, and only converted if it's in neither. Doesn't write
+    to the database, so viewing stays read-only.
+    """
+
+    key = text_hash(text)
+
+    html = app.markdown_cache.get(key)
+    if html is not None:
+        return html
+
+    try:
+        rendered = RenderedMarkdown.get(RenderedMarkdown.hash == key)
+        if rendered.config == md_config:
+            app.markdown_cache.set(key, rendered.html)
+            return rendered.html
+
+    except RenderedMarkdown.DoesNotExist:
+        pass
+
+    html, dynamic = convert(text)
+
+    if not dynamic:
+        app.markdown_cache.set(key, html)
+
+    return html
+
+
+def store(text):
+
+    """ Convert markdown `text` and store its HTML in RenderedMarkdown, unless it's dynamic or stored already. """
+
+    key = text_hash(text)
+
+    if RenderedMarkdown.select().where(RenderedMarkdown.hash == key, RenderedMarkdown.config == md_config).exists():
+        return
+
+    html, dynamic = convert(text)
+
+    if not dynamic:
+
+        RenderedMarkdown.insert(hash=key, config=md_config, html=html).on_conflict(
+            conflict_target=[RenderedMarkdown.hash],
+            preserve=[RenderedMarkdown.config, RenderedMarkdown.html]
+        ).execute()
+
+        app.markdown_cache.set(key, html)
+
+
+def markdown_fields(cls):
+
+    return [field for field in cls._meta.sorted_fields if isinstance(field, MarkdownField)]
+
+
+def sources():
+
+    """ All markdown texts in MarkdownFields of all models. """
+
+    for cls in sorted(poobrains.storage.Model.class_children(), key=lambda cls: cls.__name__):
+
+        fields = markdown_fields(cls)
+        if not fields:
+            continue
+
+        for row in cls.select(*fields).tuples().iterator():
+            for value in row:
+                if value:
+                    yield value
+
+
+def prune():
+
+    """
+    Delete RenderedMarkdown rows rendered with another configuration, or
+    whose source is in no MarkdownField anymore. Returns the number of
+    deleted rows.
+    """
+
+    count = RenderedMarkdown.delete().where(RenderedMarkdown.config != md_config).execute()
+
+    current = set([text_hash(text) for text in sources()])
+    orphans = [key for (key,) in RenderedMarkdown.select(RenderedMarkdown.hash).tuples().iterator() if not key in current]
+
+    for i in range(0, len(orphans), 500): # keeps the number of query parameters below database limits
+        count += RenderedMarkdown.delete().where(RenderedMarkdown.hash.in_(orphans[i:i+500])).execute()
+
+    return count
+
+
+@app.cron
+def prune_rendered_markdown():
+
+    count = prune()
+    app.logger.info("Deleted %d stale or orphaned markdown renderings." % count)
+
+
+@poobrains.storage.on_write
+def store_rendered_markdown(instance, op):
+
+    if op == 'delete': # orphans are left to prune, other rows might share the same text
+        return
+
+    for field in markdown_fields(instance.__class__):
+
+        value = getattr(instance, field.name)
+        if value:
+            store(value)
+
+
 class MarkdownString(str):
 
     def render(self, mode='inline'): # mode is ignored anyways
-        return jinja2.Markup(md.convert(self))
+        return jinja2.Markup(render(self))
 
 
 class MarkdownFieldAccessor(peewee.FieldAccessor):
@@ -59,6 +233,8 @@ class DisplayRenderable(markdown.inlinepatterns.Pattern):
 
         if match:
 
+            conversion.dynamic = True # output depends on the embedded instance and the user viewing it
+
             cls_name = match.group(2).lower()
             handle = match.group(3)
 
@@ -67,6 +243,7 @@ class DisplayRenderable(markdown.inlinepatterns.Pattern):
             if cls_name in renderables:
 
                 cls = renderables[cls_name.lower()]
+                poobrains.helpers.page_depends_on(cls) # also if it can't be loaded or read, that may change
                 try:
 
                     if issubclass(cls, poobrains.storage.Storable):
@@ -119,3 +296,4 @@ md = app.config['MARKDOWN_CLASS'](
 )
 
 md.references.set_loader(magic_markdown_loader)
+md_config = config_hash()
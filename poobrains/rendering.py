@@ -94,6 +94,32 @@ class Renderable(poobrains.helpers.ChildAware):
         return tpls
 
 
+    def template_cache_key(self, mode=None):
+
+        """ Everything `templates` depends on. Override along with `templates` if it uses instance state. """
+
+        return (self.__class__, mode)
+
+
+    def template(self, mode=None):
+
+        """
+        Name of the template this Renderable is rendered with in `mode`.
+        Resolutions are remembered per theme, so candidates are only built
+        and probed against the theme paths once.
+        """
+
+        key = (self.template_cache_key(mode), app.config['THEME'])
+
+        try:
+            return app.template_resolutions[key]
+
+        except KeyError:
+            name = app.jinja_env.select_template(self.templates(mode)).name
+            app.template_resolutions[key] = name
+            return name
+
+
     @classmethod
     def class_view(cls, **kwargs):
         
@@ -115,10 +141,53 @@ class Renderable(poobrains.helpers.ChildAware):
         return self
 
 
+    def fragment_cache_key(self, mode):
+
+        """ Key for caching `render(mode)` in app.fragment_cache, None means don't cache. """
+
+        return None
+
+
     def render(self, mode='full'):
+
+        if hasattr(flask.g, 'rendered_classes'): # only set when the full-page cache needs to know what went into a page
+            flask.g.rendered_classes.add(self.__class__)
+
+        cache_key = self.fragment_cache_key(mode)
+        if cache_key is not None:
+
+            fragment = app.fragment_cache.get(cache_key)
+            if fragment is not None and poobrains.helpers.versions_current(fragment['versions']):
+
+                if hasattr(flask.g, 'rendered_classes'):
+                    flask.g.rendered_classes.update(fragment['classes']) # replay what went into this fragment for the page cache
+
+                return fragment['markup']
+
+            # collect classes rendered within this fragment, so they can be replayed on cache hits
+            outer_classes = getattr(flask.g, 'rendered_classes', None)
+            flask.g.rendered_classes = set([self.__class__])
+
+            try:
+                markup = jinja2.Markup(flask.render_template(self.template(mode), content=self, mode=mode))
+                classes = flask.g.rendered_classes
+
+            finally:
+
+                if outer_classes is None:
+                    del(flask.g.rendered_classes)
+                else:
+                    outer_classes.update(flask.g.rendered_classes)
+                    flask.g.rendered_classes = outer_classes
+
+            app.fragment_cache.set(cache_key, {
+                'markup': markup,
+                'classes': classes,
+                'versions': poobrains.helpers.class_versions(classes) # writes to any of them in any process make this fragment stale
+            })
+            return markup
         
-        tpls = self.templates(mode)
-        return jinja2.Markup(flask.render_template(tpls, content=self, mode=mode))
+        return jinja2.Markup(flask.render_template(self.template(mode), content=self, mode=mode))
 
 
     
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import re
 import collections
 import math
+import functools
 import peewee
 import flask
 
@@ -12,6 +14,182 @@ import poobrains.storage
 import poobrains.auth
 
 
+def searchable_fields(cls):
+
+    """ Fields of Administerable `cls` that are searched, `_meta.search_fields` or name, title and text. """
+
+    if hasattr(cls._meta, 'search_fields'):
+        return [getattr(cls, field_name) for field_name in cls._meta.search_fields]
+
+    fields = []
+
+    if isinstance(getattr(cls, 'name', None), poobrains.storage.fields.CharField):
+        fields.append(cls.name)
+
+    if isinstance(getattr(cls, 'title', None), poobrains.storage.fields.CharField):
+        fields.append(cls.title)
+
+    if isinstance(getattr(cls, 'text', None), poobrains.storage.fields.TextField):
+        fields.append(cls.text)
+
+    return fields
+
+
+class SearchDocument(poobrains.storage.Model):
+
+    """
+    Searchable text of one Administerable, kept up to date by `update_search_index`.
+    Owner, group and access are copied from Owned instances, so search results
+    can be filtered by permissions without touching the indexed tables.
+    The full-text index on top of this table depends on the database, see `create_index`.
+    """
+
+    class Meta:
+        indexes = (
+            (('model', 'handle'), True),
+        )
+
+    model = poobrains.storage.fields.CharField(max_length=255)
+    handle = poobrains.storage.fields.CharField(max_length=255)
+    owner = poobrains.storage.fields.ForeignKeyField(poobrains.auth.User, null=True, on_delete='CASCADE', related_name='_search_documents')
+    group = poobrains.storage.fields.ForeignKeyField(poobrains.auth.Group, null=True, on_delete='SET NULL', related_name='_search_documents')
+    access = poobrains.storage.fields.CharField(null=True)
+    date = poobrains.storage.fields.DateTimeField(null=True, index=True)
+    text = poobrains.storage.fields.TextField()
+
+
+def create_index():
+
+    """
+    Create the full-text index for SearchDocument, if it doesn't exist yet.
+
+    On SQLite this is an external content FTS5 table synced by triggers, on
+    postgres a generated tsvector column with a GIN index (needs postgres 12+).
+    """
+
+    table = SearchDocument._meta.table_name
+
+    if isinstance(app.db, peewee.SqliteDatabase):
+
+        app.db.execute_sql("CREATE VIRTUAL TABLE IF NOT EXISTS %s_fts USING fts5(text, content='%s', content_rowid='id')" % (table, table))
+        app.db.execute_sql("CREATE TRIGGER IF NOT EXISTS %s_ai AFTER INSERT ON %s BEGIN INSERT INTO %s_fts(rowid, text) VALUES (new.id, new.text); END" % (table, table, table))
+        app.db.execute_sql("CREATE TRIGGER IF NOT EXISTS %s_ad AFTER DELETE ON %s BEGIN INSERT INTO %s_fts(%s_fts, rowid, text) VALUES ('delete', old.id, old.text); END" % (table, table, table, table))
+        app.db.execute_sql("CREATE TRIGGER IF NOT EXISTS %s_au AFTER UPDATE ON %s BEGIN INSERT INTO %s_fts(%s_fts, rowid, text) VALUES ('delete', old.id, old.text); INSERT INTO %s_fts(rowid, text) VALUES (new.id, new.text); END" % (table, table, table, table, table))
+
+    else: # postgres
+
+        app.db.execute_sql("ALTER TABLE %s ADD COLUMN IF NOT EXISTS document tsvector GENERATED ALWAYS AS (to_tsvector('%s'::regconfig, text)) STORED" % (table, app.config['SEARCH_LANGUAGE']))
+        app.db.execute_sql("CREATE INDEX IF NOT EXISTS %s_document ON %s USING GIN (document)" % (table, table))
+
+
+def search_query(classes, user, pattern):
+
+    """
+    One query for the SearchDocuments of all Administerables in `classes`
+    that `user` may read and that match `pattern`, best matches first.
+    Permissions are checked in SQL, through the owner, group and access
+    columns of SearchDocument. Returns None if there's nothing to search.
+    """
+
+    terms = re.findall(r'\w+', pattern.lower())
+    if not terms:
+        return None
+
+    predicate = poobrains.auth.reference_predicate(SearchDocument, [cls for cls in classes if searchable_fields(cls)], user)
+    if predicate is None:
+        return None
+
+    poobrains.helpers.page_depends_on(*classes) # the index follows writes to them
+    table = SearchDocument._meta.table_name
+    q = SearchDocument.select().where(predicate)
+
+    if isinstance(app.db, peewee.SqliteDatabase):
+
+        fts = peewee.Table('%s_fts' % table, ('rowid',))
+        match = ' '.join(['"%s"*' % term for term in terms]) # quoted, so input can't use FTS5 query syntax
+
+        q = q.join(fts, on=(fts.rowid == SearchDocument.id))
+        q = q.where(peewee.SQL('%s_fts MATCH ?' % table, [match]))
+        return q.order_by(peewee.SQL('bm25(%s_fts)' % table), SearchDocument.date.desc()) # lower bm25 is better
+
+    # postgres
+    tsquery = ' & '.join(['%s:*' % term for term in terms]) # terms are \w+ only, so this is a valid tsquery
+    q = q.where(peewee.SQL('%s.document @@ to_tsquery(%%s::regconfig, %%s)' % table, [app.config['SEARCH_LANGUAGE'], tsquery]))
+    return q.order_by(peewee.SQL('ts_rank(%s.document, to_tsquery(%%s::regconfig, %%s)) DESC' % table, [app.config['SEARCH_LANGUAGE'], tsquery]), SearchDocument.date.desc())
+
+
+def load_documents(documents, user):
+
+    """ The Administerables behind `documents`, in the same order. Costs one query per model. """
+
+    return poobrains.auth.load_handles(documents, user)
+
+
+def like_query(cls, user, pattern):
+
+    """ Fallback for `search_query` without full-text index, LIKE matching against all searchable fields. """
+
+    if isinstance(app.db, peewee.SqliteDatabase):
+        term = '*%s*' % pattern.lower()
+    else: # postgres
+        term = '%%%s%%' % pattern.lower()
+
+    clauses = [(peewee.fn.Lower(field) % term) for field in searchable_fields(cls)]
+
+    return cls.list('read', user).where(functools.reduce(peewee.operator.or_, clauses))
+
+
+def document_data(instance):
+
+    """ Column values of the SearchDocument for `instance`. """
+
+    data = poobrains.auth.reference_data(instance)
+    data['text'] = '\n'.join([str(getattr(instance, field.name)) for field in searchable_fields(instance.__class__) if getattr(instance, field.name) is not None])
+
+    return data
+
+
+def store_documents(rows):
+
+    """ Insert or update SearchDocuments from dicts as returned by `document_data`. """
+
+    SearchDocument.insert_many(rows).on_conflict(
+        conflict_target=[SearchDocument.model, SearchDocument.handle],
+        preserve=[SearchDocument.text, SearchDocument.date, SearchDocument.owner, SearchDocument.group, SearchDocument.access]
+    ).execute()
+
+    poobrains.storage.evict_counts(SearchDocument)
+
+
+@poobrains.storage.on_write
+def update_search_index(instance, op):
+
+    if not app.config['SEARCH_FULLTEXT'] or not isinstance(instance, poobrains.auth.Administerable):
+        return
+
+    if not searchable_fields(instance.__class__):
+        return
+
+    if op == 'delete':
+        SearchDocument.delete().where(SearchDocument.model == instance.__class__.__name__, SearchDocument.handle == instance.handle_string).execute()
+        poobrains.storage.evict_counts(SearchDocument)
+        return
+
+    store_documents([document_data(instance)])
+
+
+@poobrains.storage.on_reindex
+def reindex_search(cls, instances):
+
+    if not app.config['SEARCH_FULLTEXT'] or not issubclass(cls, poobrains.auth.Administerable):
+        return
+
+    if not searchable_fields(cls):
+        return
+
+    store_documents([document_data(instance) for instance in instances])
+
+
 class SearchField(poobrains.form.fields.Text):
     pass
 
@@ -89,56 +267,35 @@ class Search(poobrains.auth.Protected):
 
             flask.session['search_pattern'] = self.handle
 
+            readable = poobrains.auth.Permission.resolve(flask.g.user, [administerables[key].permissions['read'].__name__ for key in sorted(administerables)])
+
             for key in sorted(administerables):
 
                 administerable = administerables[key]
 
-                try:
-                    administerable.permissions['read'].check(flask.g.user)
+                if readable[administerable.permissions['read'].__name__] == 'grant':
                     readable_administerables.append(administerable)
 
-                except poobrains.auth.AccessDenied:
-                    pass
-
-            queries = []
-            
-            for administerable in readable_administerables:
-
-                q = administerable.list('read', flask.g.user)
-                clauses = []
-
-                if isinstance(app.db, peewee.SqliteDatabase):
-                    term = '*%s*' % self.handle.lower()
-                else: # postgres
-                    term = '%%%s%%' % self.handle.lower()
-
-                if hasattr(administerable._meta, 'search_fields'):
-
-                    for field_name in administerable._meta.search_fields:
+            if app.config['SEARCH_FULLTEXT']:
 
-                        field = getattr(administerable, field_name)
-                        clauses.append((peewee.fn.Lower(field) % term))
+                q = search_query(readable_administerables, flask.g.user, self.handle)
 
-                else:
-                    
-                    if isinstance(getattr(administerable, 'name', None), poobrains.storage.fields.CharField):
-                        clauses.append((peewee.fn.Lower(administerable.name) % term))
+                if q is not None:
+                    pagination = poobrains.storage.Pagination([q], offset, 'site.search_handle_offset', handle=self.handle)
+                    self.results = load_documents(pagination.results, flask.g.user)
+                    self.pagination = pagination.menu
 
-                    if isinstance(getattr(administerable, 'title', None), poobrains.storage.fields.CharField):
-                        clauses.append((peewee.fn.Lower(administerable.title) % term)) # LIKE clause
-                    
-                    if isinstance(getattr(administerable, 'text', None), poobrains.storage.fields.TextField):
-                        clauses.append((peewee.fn.Lower(administerable.text) % term)) # LIKE clause
+            else:
 
-                if len(clauses):
-                    queries.append(q.where(reduce(peewee.operator.or_, clauses)))
-                else:
-                    continue
+                queries = []
 
+                for administerable in readable_administerables:
+                    if searchable_fields(administerable):
+                        queries.append(like_query(administerable, flask.g.user, self.handle))
 
-            pagination = poobrains.storage.Pagination(queries, offset, 'site.search_handle_offset', handle=self.handle)
-            self.results = pagination.results
-            self.pagination = pagination.menu
+                pagination = poobrains.storage.Pagination(queries, offset, 'site.search_handle_offset', handle=self.handle)
+                self.results = pagination.results
+                self.pagination = pagination.menu
 
 
         elif len(self.handle) > 0:
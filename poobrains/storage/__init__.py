@@ -2,6 +2,13 @@
 
 # external imports
 import math
+import json
+import zlib
+import base64
+import decimal
+import datetime
+import operator
+import functools
 import collections
 import re
 import copy
@@ -29,6 +36,58 @@ if isinstance(app.db, peewee.SqliteDatabase):
         return re.search(regexp, value) is not None
 
 
+write_hooks = []
+
+def on_write(func):
+
+    """
+    decorator. Register a function to be called as func(instance, op) after a
+    `Model` instance was saved or deleted. op is one of 'create', 'update' and
+    'delete'. Mostly used to keep caches and derived data up to date.
+    """
+
+    write_hooks.append(func)
+    return func
+
+
+prefetch_hooks = []
+
+def on_prefetch(func):
+
+    """
+    decorator. Register a function to be called as func(instances) with
+    every page of instances loaded for a listing. Used to load related data
+    for all of them at once, instead of lazily per instance while rendering.
+    """
+
+    prefetch_hooks.append(func)
+    return func
+
+
+def prefetch(instances):
+
+    """ Run all prefetch hooks on `instances`, see `on_prefetch`. """
+
+    if instances:
+        for hook in prefetch_hooks:
+            hook(instances)
+
+
+reindex_hooks = []
+
+def on_reindex(func):
+
+    """
+    decorator. Register a function to be called as func(cls, instances) by the
+    `reindex` command, with batches of instances of the `Model` class cls.
+    It should rebuild all data it derives from these instances in bulk.
+    Calls happen inside a transaction per batch.
+    """
+
+    reindex_hooks.append(func)
+    return func
+
+
 def RegexpConstraint(field_name, regexp):
 
     operation = app.db._operations['REGEXP'] # peewee.OP.REGEXP used to always hold the correct value, what happen?
@@ -170,10 +229,118 @@ class Model(peewee.Model, poobrains.helpers.ChildAware, metaclass=ModelBase):
         return query
 
 
-    def save(self, *args, **kwargs):
+    @classmethod
+    def keyset_ordering(cls):
+
+        """
+        _meta.order_by, extended with the primary key fields it's missing.
+        This makes the ordering total, which keyset pagination depends on.
+        """
+
+        ordering = list(cls._meta.order_by or [])
+        ordered_fields = [o.node for o in ordering]
+
+        for field in cls._meta.get_primary_keys():
+            if not any([field is ordered_field for ordered_field in ordered_fields]): # no 'in', Field.__eq__ builds an expression
+                ordering.append(field.asc())
+
+        return ordering
+
+
+    @classmethod
+    def position(cls, handle):
+
+        """
+        Zero-based position of the row with `handle` in this models' ordering.
+
+        Costs loading that row and one COUNT of the rows before it. The COUNT
+        still visits every row before the handle, an index only spares it
+        the table. Cheap enough for the "back to listing" links this is for,
+        unlike an in-memory index of all rows that every write invalidates.
+        """
+
+        instance = cls.load(handle) # raises cls.DoesNotExist for unknown handles
+
+        ordering = cls.keyset_ordering()
+        values = instance.keyset_values(ordering)
+
+        return cls.select().where(cls.keyset_clause(ordering, values, before=True)).count()
+
+
+    def keyset_values(self, ordering):
+
+        """ This rows' values of the fields in `ordering`, for `keyset_clause`. Foreign keys give ids, not instances. """
+
+        return [self.__data__.get(o.node.name) for o in ordering]
+
+
+    @classmethod
+    def keyset_clause(cls, ordering, values, before=False):
+
+        """
+        WHERE clause for all rows coming after (or `before`) the row with sort
+        key `values` in `ordering`. NULL values are placed where the database
+        sorts them: postgres puts them last in ascending order, SQLite first.
+        """
+
+        nulls_low = not isinstance(app.db, peewee.PostgresqlDatabase) # NULL sorts below every value
+
+        clauses = []
+
+        for i, o in enumerate(ordering):
+
+            descending = o.direction == 'DESC'
+            nulls_first = descending != nulls_low
+            nulls_beyond = nulls_first if before else not nulls_first # NULLs lie on the side we're looking at
+
+            if values[i] is None:
+                clause = None if nulls_beyond else o.node.is_null(False) # from a NULL, only values lie on the other side
+
+            else:
+
+                if descending != before:
+                    clause = o.node < values[i]
+                else:
+                    clause = o.node > values[i]
+
+                if nulls_beyond:
+                    clause = clause | o.node.is_null()
+
+            if clause is None:
+                continue
+
+            for j in range(0, i):
+                clause = (ordering[j].node.is_null() if values[j] is None else ordering[j].node == values[j]) & clause
+
+            clauses.append(clause)
+
+        if not clauses:
+            return peewee.SQL('1 = 0') # the row is the last one in that direction
+
+        return functools.reduce(operator.or_, clauses)
+
+
+    def save(self, force_insert=False, only=None):
 
         self.validate()
-        return super(Model, self).save(*args, **kwargs)
+
+        op = 'create' if force_insert or self._pk is None else 'update'
+        rv = super(Model, self).save(force_insert=force_insert, only=only)
+
+        for hook in write_hooks:
+            hook(self, op)
+
+        return rv
+
+
+    def delete_instance(self, *args, **kwargs):
+
+        rv = super(Model, self).delete_instance(*args, **kwargs)
+
+        for hook in write_hooks:
+            hook(self, 'delete')
+
+        return rv
 
 
     def __repr__(self):
@@ -228,9 +395,39 @@ class Storable(Model, poobrains.rendering.Renderable):
         return instance.view(handle=handle, mode=mode, **kwargs)
 
 
+    def fragment_cache_key(self, mode):
+
+        """
+        Rendered Storables are cached per class, handle, mode, blueprint (URLs
+        differ between site and admin) and the permission fingerprint of the
+        current user, so users with the same access share fragments.
+
+        Classes can opt out by setting `fragment_cache` in their Meta to False
+        or to a list of modes that may be cached.
+        """
+
+        fragment_cache = getattr(self._meta, 'fragment_cache', True)
+        if not fragment_cache or (fragment_cache is not True and not mode in fragment_cache):
+            return None
+
+        user = getattr(flask.g, 'user', None)
+        if user is None or not flask.has_request_context():
+            return None
+
+        try:
+            if self._pk is None or self.is_dirty():
+                return None # unsaved or modified instances, i.e. previews
+        except peewee.DoesNotExist:
+            return None
+
+        return (self.__class__, self.handle_string, mode, flask.request.blueprint, user.permission_fingerprint)
+
+
     @classmethod
     def list(cls, op, user, handles=None, ordered=True, fields=[]):
 
+        poobrains.helpers.page_depends_on(cls)
+
         if ordered: # whether to use the default ordering for this model. mostly here because doing this *always* would break using this in UNIONs
             query = cls.ordered(*fields)
         else:
@@ -255,6 +452,106 @@ class Storable(Model, poobrains.rendering.Renderable):
         return query
 
 
+def count(query):
+
+    """
+    Row count of `query`, cached in app.count_cache by its SQL and parameters.
+    With PAGINATION_APPROXIMATE_COUNT set, big postgres results are counted
+    by the query planners' estimate instead.
+    """
+
+    sql, params = query.sql()
+
+    try:
+        key = (sql, tuple(params))
+        hash(key)
+    except TypeError: # unhashable parameter
+        return query.count()
+
+    rv = app.count_cache.get(key)
+    if rv is not None:
+        return rv
+
+    threshold = app.config['PAGINATION_APPROXIMATE_COUNT']
+    if threshold and isinstance(app.db, peewee.PostgresqlDatabase):
+
+        plan = app.db.execute_sql('EXPLAIN (FORMAT JSON) %s' % sql, params).fetchone()[0]
+        if isinstance(plan, str): # depends on the driver
+            plan = json.loads(plan)
+
+        rv = int(plan[0]['Plan']['Plan Rows'])
+        if rv < threshold:
+            rv = None # estimates are too rough for small results
+
+    if rv is None:
+        rv = query.count()
+
+    app.count_cache.set(key, rv)
+    return rv
+
+
+def evict_counts(model):
+
+    """ Drop cached counts of queries on the table of `model`. Bulk writes, which skip write hooks, must call this themselves. """
+
+    table = '"%s"' % model._meta.table_name # quoted, so it doesn't match other tables or columns sharing a prefix
+    app.count_cache.evict(lambda key, count: table in key[0])
+
+
+@on_write
+def invalidate_count_cache(instance, op):
+    evict_counts(instance.__class__)
+
+
+def evict_fragments(model_name):
+
+    """
+    Stale cached renderings of Storables of class `model_name` in all app
+    processes, for changes that don't go through `Model.save`, like counters.
+    """
+
+    try:
+        cls = Storable.class_children_keyed()[model_name]
+    except KeyError:
+        return
+
+    bump_class_versions(cls)
+
+
+def bump_class_versions(cls):
+
+    """
+    Stale everything cached from rows of Storable class `cls`, in all app
+    processes. Bases are bumped too, pages may depend on them.
+    """
+
+    for base in cls.__mro__:
+        if isinstance(base, type) and issubclass(base, Storable):
+            poobrains.helpers.bump_shared_version(poobrains.helpers.class_version_name(base))
+
+
+@on_write
+def invalidate_page_cache(instance, op):
+
+    """ Stale cached pages and fragments that show anything of the written instances' class. """
+
+    if isinstance(instance, Storable):
+        bump_class_versions(instance.__class__)
+
+
+def autocomplete_field(cls):
+
+    """ Field of Storable `cls` that autocompletion matches against, `_meta.autocomplete_field`, name or the first handle field. """
+
+    if hasattr(cls._meta, 'autocomplete_field'):
+        return getattr(cls, cls._meta.autocomplete_field)
+
+    if isinstance(getattr(cls, 'name', None), peewee.CharField):
+        return cls.name
+
+    return getattr(cls, cls._meta.handle_fields[0])
+
+
 class Named(Storable):
 
     class Meta:
@@ -302,6 +599,7 @@ class Listing(poobrains.rendering.Renderable):
     def __init__(self, cls, mode='teaser', title=None, query=None, offset=0, limit=None, menu_actions=None, menu_related=None, pagination_options=None, **kwargs):
 
         super(Listing, self).__init__(**kwargs)
+        poobrains.helpers.page_depends_on(cls) # custom queries don't go through cls.list
         self.cls = cls
         self.mode = mode
         self.offset = offset
@@ -351,6 +649,89 @@ class Listing(poobrains.rendering.Renderable):
         return tpls
 
 
+    def template_cache_key(self, mode=None):
+        return (self.__class__, mode, self.cls)
+
+
+def group_handles(references):
+
+    """
+    Handle strings by model name, from (model name, handle) pairs, in order
+    of first appearance. For loading or looking up data of many instances
+    of different models at once, see `reference_clause`.
+    """
+
+    grouped = collections.OrderedDict()
+    for model, handle in references:
+
+        if not model in grouped:
+            grouped[model] = []
+
+        grouped[model].append(handle)
+
+    return grouped
+
+
+def instance_references(instances):
+
+    """ (model name, handle) pairs of Storables `instances`, for `group_handles`. """
+
+    return [(instance.__class__.__name__, instance.handle_string) for instance in instances]
+
+
+def reference_clause(references, grouped):
+
+    """ SQL condition on `references`, a model with model and handle columns, matching the handles `grouped` by `group_handles`. """
+
+    clauses = [(references.model == model) & (references.handle.in_(handles)) for model, handles in grouped.items()]
+    return functools.reduce(operator.or_, clauses)
+
+
+def cursor_value(field, value):
+
+    """
+    `value` from a pagination cursor, converted for comparing against `field`.
+    Raises ValueError for anything but a scalar matching the fields' type,
+    cursors come from URLs and can be anything.
+    """
+
+    if value is None:
+        return None
+
+    if isinstance(field, peewee.ForeignKeyField):
+        field = field.rel_field
+
+    if isinstance(field, peewee.BooleanField):
+        if not isinstance(value, bool):
+            raise ValueError("Cursor value is no boolean: %r" % (value,))
+        return value
+
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError("Cursor value is no scalar: %r" % (value,))
+
+    if isinstance(field, (peewee.CharField, peewee.TextField)):
+        expected = str
+    elif isinstance(field, peewee.IntegerField):
+        expected = int
+    elif isinstance(field, (peewee.FloatField, peewee.DecimalField)):
+        expected = (int, float, decimal.Decimal)
+    elif isinstance(field, peewee.DateTimeField):
+        expected = datetime.datetime
+    elif isinstance(field, peewee.DateField):
+        expected = datetime.date
+    elif isinstance(field, peewee.TimeField):
+        expected = datetime.time
+    else:
+        raise ValueError("Can't check cursor values for %s." % field.__class__.__name__)
+
+    value = field.adapt(value) # parses dates, leaves unparseable values as they are
+
+    if not isinstance(value, expected):
+        raise ValueError("Cursor value doesn't match %s: %r" % (field.__class__.__name__, value))
+
+    return value
+
+
 class Pagination(object):
 
     menu = None # the actual pagination menu
@@ -364,13 +745,23 @@ class Pagination(object):
     num_results = None
     num_pages = None
     current_page = None
+    keyset = None # whether keyset pagination is used where possible
+    orderings = None # query index -> total ordering of keyset-capable queries
+    last = None # (query index, result) of the last result on this page
+    next_cursor = None # encoded sort key of the last result, for the link to the next page
+    scope = None # identifies this pagination in its cursors, so other paginations on the same page ignore them
 
 
-    def __init__(self, queries, offset, endpoint, limit=None, **options):
+    def __init__(self, queries, offset, endpoint, limit=None, keyset=None, **options):
         
         self.queries = queries
         self.offset = offset
         self.endpoint = endpoint
+
+        for query in queries:
+            model = getattr(query, 'model', None)
+            if isinstance(model, type):
+                poobrains.helpers.page_depends_on(model)
         self.options = options
 
         if limit is not None:
@@ -378,20 +769,160 @@ class Pagination(object):
         else:
             self.limit = app.config['PAGINATION_COUNT']
 
+        if keyset is not None:
+            self.keyset = keyset
+        else:
+            self.keyset = app.config['PAGINATION_KEYSET']
+
+        self.orderings = {}
+        if self.keyset:
+            self.queries = [self.keyset_query(idx, q) for idx, q in enumerate(self.queries)]
+
+        models = [getattr(query, 'model', None) for query in self.queries]
+        self.scope = zlib.crc32(('%s:%s' % (endpoint, ','.join([model.__name__ for model in models if isinstance(model, type)]))).encode('utf-8'))
+
         self.menu = False
-        self.counts = [(q, q.count()) for q in self.queries]
+        self.counts = [(q, count(q)) for q in self.queries]
         self.results = []
         self.page_info = collections.OrderedDict()
         self.num_results = sum([x[1] for x in self.counts])
         self.num_pages = int(math.ceil(float(self.num_results) / self.limit))
         self.current_page = int(math.floor(self.offset / float(self.limit))) + 1
 
+        cursor = None
+        if self.keyset and 'after' in flask.request.args:
+            cursor = self.decode_cursor(flask.request.args['after'])
+
+        if cursor is not None:
+            self.fetch_after(*cursor)
+        else:
+            self.fetch_offset()
+
+        prefetch(self.results)
+
+        if self.keyset and len(self.results) == self.limit:
+            self.next_cursor = self.encode_cursor()
+
+        if self.num_pages > 1:
+
+            self.menu = poobrains.rendering.Menu('pagination')
+            previous_page_num = 0
+
+            for page_num in self.menu_pages():
+
+                if page_num > previous_page_num + 1:
+                    self.menu.append(None, '…', False) # gap for skipped pages
+
+                active = page_num == self.current_page
+                kw = copy.copy(self.options)
+                kw['offset'] = (page_num - 1) * self.limit
+
+                if page_num == self.current_page + 1 and self.next_cursor:
+                    kw['after'] = self.next_cursor # the offset stays in the url as fallback and for the menu
+
+                self.menu.append(
+                    flask.url_for(self.endpoint, **kw),
+                    page_num,
+                    active
+                )
+
+                previous_page_num = page_num
+
+
+    def menu_pages(self):
+
+        """ Sorted numbers of the pages linked in the menu: first, last and the ones around the current page. """
+
+        window = app.config['PAGINATION_WINDOW']
+        lower = max(1, self.current_page - window)
+        upper = min(self.num_pages, self.current_page + window)
+
+        return sorted(set([1, self.num_pages]).union(range(lower, upper + 1)))
+
+
+    def keyset_query(self, idx, query):
+
+        """
+        Give `query` a total ordering if it's a plain select ordered by its
+        models' _meta.order_by, which makes it usable for keyset pagination.
+        Other queries (unions, custom orderings) are only paged by offset.
+        """
+
+        model = getattr(query, 'model', None)
+
+        if not isinstance(query, peewee.ModelSelect) or not isinstance(model, type) or not issubclass(model, Model):
+            return query
+
+        order_by = list(query._order_by or [])
+        if not model._meta.order_by or len(order_by) != len(model._meta.order_by) or \
+        not all([a is b for a, b in zip(order_by, model._meta.order_by)]): # set by Model.ordered
+            return query
+
+        ordering = model.keyset_ordering()
+        self.orderings[idx] = ordering
+
+        return query.order_by(*ordering)
+
+
+    def encode_cursor(self):
+
+        idx, result = self.last
+
+        if not idx in self.orderings:
+            return None
+
+        values = result.keyset_values(self.orderings[idx])
+
+        return base64.urlsafe_b64encode(json.dumps([self.scope, idx, values], default=str).encode('utf-8')).decode('ascii')
+
+
+    def decode_cursor(self, cursor):
+
+        """ (query index, sort key) from `cursor`, or None if it's invalid or meant for another pagination. """
+
+        try:
+            scope, idx, values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+
+            if scope != self.scope:
+                return None
+
+            if not isinstance(idx, int) or not idx in self.orderings or not isinstance(values, list) or len(values) != len(self.orderings[idx]):
+                raise ValueError("Malformed cursor.")
+
+            return idx, [cursor_value(o.node, value) for o, value in zip(self.orderings[idx], values)]
+
+        except (ValueError, TypeError, OverflowError, UnicodeError):
+            app.logger.debug("Invalid pagination cursor, falling back to offset: %s" % cursor)
+            return None
+
+
+    def fetch_after(self, idx, values):
+
+        """ Fill this page with results coming after sort key `values` in query `idx` and the ones after it. """
+
+        for query_idx in range(idx, len(self.queries)):
+
+            query = self.queries[query_idx]
+
+            if query_idx == idx:
+                query = query.where(query.model.keyset_clause(self.orderings[idx], values))
+
+            for result in query.limit(self.limit - len(self.results)):
+                self.results.append(result)
+                self.last = (query_idx, result)
+
+            if len(self.results) >= self.limit:
+                break
+
+
+    def fetch_offset(self):
+
         position = 0
 
         range_lower = self.offset
         range_upper = self.offset + self.limit - 1
 
-        for query, count in self.counts:
+        for idx, (query, count) in enumerate(self.counts):
 
             if count > 0:
 
@@ -420,26 +951,10 @@ class Pagination(object):
 
                     for result in query:
                         self.results.append(result)
+                        self.last = (idx, result)
 
                 position += count
 
-        if self.num_pages > 1:
-
-            self.menu = poobrains.rendering.Menu('pagination')
-
-            for i in range(0, self.num_pages):
-
-                page_num = i + 1
-                active = page_num == self.current_page
-                kw = copy.copy(self.options)
-                kw['offset'] = i * self.limit
-
-                self.menu.append(
-                    flask.url_for(self.endpoint, **kw),
-                    page_num,
-                    active
-                )
-
 
 class StorableParamType(poobrains.form.types.ParamType):
 
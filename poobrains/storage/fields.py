@@ -9,6 +9,7 @@ from peewee import AutoField, Check
 # parent imports
 from poobrains import app
 import poobrains.helpers
+import poobrains.errors
 import poobrains.form
 
 
@@ -53,32 +54,98 @@ class StorableInstanceParamType(poobrains.form.types.ParamType):
 poobrains.form.types.StorableInstanceParamType = StorableInstanceParamType
 
 
-class ForeignKeyChoice(poobrains.form.fields.Text, metaclass=poobrains.form.fields.BoundFieldMeta):
+class StorableChoice(poobrains.form.fields.Text):
 
     """
-    Note: This field expects to be bound to a ForeignKeyField.
+    Choose instances of `storable` by handle.
+
+    Unless choices are passed explicitly, none are listed when the form is
+    built. The template offers them on demand from the autocomplete endpoint
+    instead, so building a form doesn't scale with the size of the table.
+
     Note: This is a FORM field, not a storage field.
     """
 
-    __metaclass__ = poobrains.form.fields.BoundFieldMeta
-
     storable = None
 
-    def __init__(self, fkfield, choices=None, **kwargs):
+    class Meta:
+        clone_props = poobrains.form.fields.Text._meta.clone_props + ['storable']
+
+
+    def __init__(self, storable=None, **kwargs):
+
+        if not storable is None:
+            self.storable = storable
+
+        choices = kwargs.get('choices')
+        kwargs['type'] = StorableInstanceParamType(self.storable, choices=[choice for choice, _ in choices] if choices else None)
+
+        super(StorableChoice, self).__init__(**kwargs)
+
+
+    @property
+    def list_id(self):
+
+        return "list-%s" % self.ref_id # always, the datalist is filled by autocompletion
+
+
+    @property
+    def autocomplete_url(self):
+
+        return flask.url_for('autocomplete', model=self.storable.__name__)
+
+
+    @property
+    def values(self):
+
+        """ Values to render inputs for, multi fields get an empty one for adding another instance. """
 
-        self.storable = fkfield.rel_model # FIXME: Not necessarily a Storable, can be direct child of Model, too!
-                
-        if not choices:
+        if self.multi:
+            return list(self.value or []) + [None]
 
-            choices = []
-            for choice in self.storable.list('read', flask.g.user):
-                choices.append((choice, choice.title))
+        return [self.value]
 
-        kwargs['choices'] = choices
 
-        kwargs['type'] = StorableInstanceParamType(self.storable, choices=[choice for choice, _ in choices])
+    def bind(self, value):
+
+        """ Look up all submitted handles with one query, not one per handle. """
+
+        values = value if self.multi else [value]
+        handles = [handle for handle in values if handle] # skip the empty input of multi fields
+
+        instances = {}
+        if handles:
+            for instance in self.storable.list('read', flask.g.user, handles=[self.storable.string_handle(handle) for handle in handles]):
+                instances[instance.handle_string] = instance
+
+        missing = [handle for handle in handles if not handle in instances]
+        if missing:
+
+            e = poobrains.errors.ValidationError("No such %s: %s." % (self.storable.__name__, ', '.join(missing)))
+            self.errors.append(e)
+            raise poobrains.errors.CompoundError([e])
+
+        if self.multi:
+            super(StorableChoice, self).bind([instances[handle] for handle in handles])
+        else:
+            super(StorableChoice, self).bind(instances[handles[0]] if handles else '')
+
+poobrains.form.fields.StorableChoice = StorableChoice
+
+
+class ForeignKeyChoice(StorableChoice, metaclass=poobrains.form.fields.BoundFieldMeta):
+
+    """
+    Note: This field expects to be bound to a ForeignKeyField.
+    Note: This is a FORM field, not a storage field.
+    """
+
+    __metaclass__ = poobrains.form.fields.BoundFieldMeta
+
+    def __init__(self, fkfield, **kwargs):
 
-        super(ForeignKeyChoice, self).__init__(**kwargs)
+        kwargs.pop('type', None) # StorableInstanceParamType without choices, set by StorableChoice
+        super(ForeignKeyChoice, self).__init__(storable=fkfield.rel_model, **kwargs) # FIXME: Not necessarily a Storable, can be direct child of Model, too!
 
 poobrains.form.fields.ForeignKeyChoice = ForeignKeyChoice
 
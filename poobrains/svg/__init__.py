@@ -70,6 +70,8 @@ class SVG(poobrains.auth.Protected):
 
 class Dataset(poobrains.commenting.Commentable):
 
+    class Meta:
+        fragment_cache = False # plots depend on datapoints
 
     title = poobrains.storage.fields.CharField()
     description = poobrains.md.MarkdownField(null=True)
@@ -332,6 +334,9 @@ class Plot(SVG):
 
 class MapDataset(poobrains.commenting.Commentable):
 
+    class Meta:
+        fragment_cache = False # plots depend on datapoints
+
     title = poobrains.storage.fields.CharField()
     description = poobrains.md.MarkdownField(null=True)
 
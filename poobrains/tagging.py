@@ -3,8 +3,10 @@
 """ The tagging system. """
 
 import collections
+import datetime
 import peewee
 import flask
+from playhouse import migrate
 
 #import poobrains
 from poobrains import app
@@ -26,12 +28,15 @@ class Tag(poobrains.auth.Named):
     title = poobrains.storage.fields.CharField()
     parent = poobrains.storage.fields.ForeignKeyField('self', null=True, constraints=[peewee.Check('parent_id <> id')]) # FIXME: Yes, this is no proper protection against loops
     description = poobrains.md.MarkdownField()
+    path = poobrains.storage.fields.CharField(null=True, index=True, form_widget=None) # materialized path, ids of all ancestors and this tag, like /1/5/9/
+    item_count = poobrains.storage.fields.IntegerField(default=0, form_widget=None) # number of tagged items regardless of permissions, maintained by sync_memberships. Not for display, see readable_item_count
 
     offset = None
 
 
     class Meta:
 
+        fragment_cache = ['teaser', 'inline'] # full mode depends on offset
         modes = collections.OrderedDict([
             ('add', 'create'),
             ('teaser', 'read'),
@@ -49,34 +54,56 @@ class Tag(poobrains.auth.Named):
     
     
     @classmethod
-    def class_tree(cls, root=None, current_depth=0):
-       
-        if current_depth == 0:
-            tree = poobrains.rendering.Tree(root=poobrains.rendering.RenderString(root.name), mode='inline')
-        else:
-            tree = poobrains.rendering.Tree(root=root, mode='inline')
+    def class_tree(cls, root=None):
 
-        if current_depth > 100:
+        """ Tree of all descendants of `root`, or of all tags if root is None. Takes one query. """
 
-            if root:
-                message = "Possibly incestuous tag: '%s'."  % root.name
-            else:
-                message = "Possibly incestuous tag, but don't have a root for this tree. Are you fucking with current_depth manually?"
+        poobrains.helpers.page_depends_on(cls)
 
-            app.logger.error(message)
-            return tree 
+        if root is None:
+            tree = poobrains.rendering.Tree(root=poobrains.rendering.RenderString('Tags'), mode='inline')
+            tags = cls.select().order_by(cls.path, cls.name)
+        else:
+            tree = poobrains.rendering.Tree(root=poobrains.rendering.RenderString(root.name), mode='inline')
+            if root.path:
+                tags = cls.select().where(path_prefix(root.path), cls.id != root.id).order_by(cls.path, cls.name)
+            else: # paths not backfilled yet, see upgrade
+                tags = cls.select().where(cls.id != root.id).order_by(cls.path, cls.name)
 
-        tags = cls.select().where(cls.parent == root)
+        trees = {None if root is None else root.id: tree}
+        subtrees = []
 
         for tag in tags:
-            tree.children.append(tag.tree(current_depth=current_depth+1))
+            trees[tag.id] = poobrains.rendering.Tree(root=tag, mode='inline')
+            subtrees.append(trees[tag.id])
+
+        for subtree in subtrees: # linked by parent, so tags without a path still end up in the right place
+
+            tag = subtree.root
+            if tag.parent_id in trees:
+                trees[tag.parent_id].children.append(subtree)
+            elif root is None or root.path:
+                app.logger.error("Tag '%s' has a broken path: %s" % (tag.name, tag.path))
+            # else: not a descendant of root
 
         return tree
 
 
-    def tree(self, current_depth=0):
+    def tree(self):
+
+        return self.__class__.class_tree(root=self)
+
+
+    def materialized_path(self):
+
+        """ Compute the path of this tag from its parents, see `path`. """
 
-        return self.__class__.class_tree(root=self, current_depth=current_depth)
+        if self.parent is None:
+            return '/%d/' % self.id
+
+        parent_path = self.parent.path or self.parent.materialized_path() # fallback for paths not built yet
+
+        return '%s%d/' % (parent_path, self.id)
 
 
     @poobrains.auth.protected
@@ -98,34 +125,31 @@ class Tag(poobrains.auth.Named):
 
     def list_tagged(self):
 
-        bindings = TagBinding.select().where(TagBinding.tag == self).limit(app.config['PAGINATION_COUNT'])
-        bindings_by_model = collections.OrderedDict()
-        queries = []
-
-        for binding in bindings:
-
-            if not binding.model in bindings_by_model:
-                bindings_by_model[binding.model] = []
-
-            bindings_by_model[binding.model].append(binding)
+        """
+        Pagination over everything tagged with this tag that the current
+        user may read, newest first. Paginates over TagMemberships in one
+        query, results are the tagged instances themselves.
+        """
 
-        #bindings_by_model = sorted(bindings_by_model) # re-order by model name
+        q = tagged_query(self, flask.g.user)
+        pagination = poobrains.storage.Pagination([q] if q is not None else [], self.offset, 'site.tag_handle_offset', handle=self.handle_string)
+        pagination.results = poobrains.auth.load_handles(pagination.results, flask.g.user)
 
-        for model_name, bindings in bindings_by_model.items():
+        return pagination
 
-            try:
-                model = poobrains.storage.Storable.class_children_keyed()[model_name]
-            except KeyError:
-                app.logger.error("TagBinding for unknown model: %s" % model_name)
-                continue
 
-            handles = [model.string_handle(binding.handle) for binding in bindings]
-            queries.append(model.list('read', user=flask.g.user, handles=handles))
+    def readable_item_count(self):
 
+        """
+        Number of tagged items the current user may read. `item_count` counts
+        all of them, showing it would tell how many private items there are.
+        """
 
-        pagination = poobrains.storage.Pagination(queries, self.offset, 'site.tag_handle_offset')
+        q = tagged_query(self, flask.g.user)
+        if q is None:
+            return 0
 
-        return pagination
+        return poobrains.storage.count(q)
 
 
     def looping(self, descendants=None):
@@ -133,7 +157,14 @@ class Tag(poobrains.auth.Named):
         """ loop detection """
 
         if descendants is None:
-            descendants = []
+
+            if self.parent_id is None:
+                return False
+
+            if self.path and self.parent.path: # the new parent must not be a descendant, i.e. have a path starting with ours
+                return self.parent_id == self.id or self.parent.path.startswith(self.path)
+
+            descendants = [] # walk up the hierarchy for paths not built yet
 
         if self.id in descendants:
             return True
@@ -153,21 +184,76 @@ class Tag(poobrains.auth.Named):
             raise poobrains.errors.ValidationError("'%s' is a descendant of this tag and thus can't be used as parent!" % self.parent.title, field='parent')
 
 
-    def save(self, *args, **kwargs):
+    def save(self, force_insert=False, only=None):
         if not self.title:
             self.title = self.name.replace('-', ' ').title()
 
-        return super(Tag, self).save(*args, **kwargs)
+        if only is None and self._pk is not None: # item_count is only ever changed by atomic updates, don't overwrite it with a stale value
+            only = [field for field in self._meta.sorted_fields if not field is Tag.item_count]
+
+        old_path = self.path
+        rv = super(Tag, self).save(force_insert=force_insert, only=only)
+
+        path = self.materialized_path() # needs the id, so only possible after saving
+        if path != old_path:
+
+            Tag.update(path=path).where(Tag.id == self.id).execute()
+
+            if old_path: # move all descendants along
+                Tag.update(
+                    path=peewee.Value(path).concat(peewee.fn.SUBSTR(Tag.path, len(old_path) + 1))
+                ).where(path_prefix(old_path), Tag.id != self.id).execute()
+
+            self.path = path
+
+        return rv
 
 app.site.add_listing(Tag, '/tag/', mode='teaser', endpoint='tag')
 app.site.add_view(Tag, '/tag/<handle>/', mode='full', endpoint='tag_handle')
 app.site.add_view(Tag, '/tag/<handle>/+<int:offset>', mode='full', endpoint='tag_handle_offset')
 
 
+def path_prefix(path):
+
+    """
+    Clause for all tags whose path starts with `path`. peewees' startswith
+    is case-insensitive, which can't use the index on path. Its LIKE
+    operator becomes GLOB on SQLite, hence the wildcard switch. Paths are
+    only ids and slashes, so need no escaping.
+    """
+
+    wildcard = '*' if isinstance(app.db, peewee.SqliteDatabase) else '%'
+    return Tag.path.like(path + wildcard)
+
+
+@poobrains.storage.on_reindex
+def reindex_tag_paths(cls, instances):
+
+    if not issubclass(cls, Tag):
+        return
+
+    parents = dict(Tag.select(Tag.id, Tag.parent).tuples()) # id -> parent id, so paths can be built without a query per tag
+
+    for tag in instances:
+
+        ids = []
+        current = tag.id
+        while current is not None and len(ids) <= len(parents): # length guard against loops in broken data
+            ids.insert(0, current)
+            current = parents.get(current)
+
+        path = '/%s/' % '/'.join([str(id) for id in ids])
+        if path != tag.path:
+            Tag.update(path=path).where(Tag.id == tag.id).execute()
+
+
 class TagBinding(poobrains.auth.Administerable):
 
     class Meta:
         order_by = ['-priority']
+        indexes = (
+            (('model', 'handle'), False),
+        )
 
     tag = poobrains.storage.fields.ForeignKeyField(Tag, related_name='_bindings')
     model = poobrains.storage.fields.CharField()
@@ -175,26 +261,269 @@ class TagBinding(poobrains.auth.Administerable):
     priority = poobrains.storage.fields.IntegerField()
 
 
-class TaggingField(poobrains.form.fields.Select):
-    
-    def __init__(self, dry=False, **kwargs):
+@poobrains.storage.on_write
+def invalidate_tagged_fragments(instance, op):
+
+    if isinstance(instance, TagBinding):
+
+        poobrains.storage.evict_fragments(instance.model)
+        poobrains.storage.evict_fragments(Tag.__name__)
+
+
+class TagMembership(poobrains.storage.Model):
+
+    """
+    Index of tagged items by tag, maintained by `sync_memberships`.
+    Owner, group and access are copied from the tagged item, so listings
+    of a tag can be filtered by permissions and paginated in one query.
+    """
+
+    class Meta:
+        order_by = ['-date', '-id']
+        indexes = (
+            (('tag', 'model', 'handle'), True),
+            (('tag', 'date'), False),
+            (('model', 'handle'), False),
+        )
+
+    tag = poobrains.storage.fields.ForeignKeyField(Tag, on_delete='CASCADE', related_name='_memberships')
+    model = poobrains.storage.fields.CharField(max_length=255)
+    handle = poobrains.storage.fields.CharField(max_length=255)
+    owner = poobrains.storage.fields.ForeignKeyField(poobrains.auth.User, null=True, on_delete='CASCADE', related_name='_tag_memberships')
+    group = poobrains.storage.fields.ForeignKeyField(poobrains.auth.Group, null=True, on_delete='SET NULL', related_name='_tag_memberships')
+    access = poobrains.storage.fields.CharField(null=True)
+    date = poobrains.storage.fields.DateTimeField() # date of the tagged item, or when it was tagged if it has none
+
+
+def tagged_query(tag, user):
+
+    """
+    TagMemberships of `tag` for all items `user` may read, ordered for keyset pagination.
+    Returns None if the user can't read any of the Taggables.
+    """
+
+    predicate = poobrains.auth.reference_predicate(TagMembership, Taggable.class_children(), user)
+    if predicate is None:
+        return None
+
+    poobrains.helpers.page_depends_on(TagBinding, *Taggable.class_children()) # memberships follow bindings and tagged items
+    return TagMembership.ordered().where(TagMembership.tag == tag, predicate)
+
+
+def membership_data(instance):
+
+    """ Column values for the TagMemberships of Taggable `instance`, without tag. """
+
+    data = poobrains.auth.reference_data(instance)
+
+    if data['date'] is None: # the column isn't nullable, callers fill in when the item was tagged
+        del(data['date'])
+
+    return data
+
+
+def adjust_item_counts(tag_ids, delta):
+
+    if tag_ids:
+        Tag.update(item_count=Tag.item_count + delta).where(Tag.id.in_(list(tag_ids))).execute()
+        poobrains.storage.evict_counts(Tag)
+
+
+def sync_memberships(instance):
+
+    """
+    Bring the TagMemberships of Taggable `instance` in line with its TagBindings
+    and its current owner, group, access and date. Per-tag item counts are
+    adjusted by the difference. Returns the ids of tags whose counts changed.
+    """
 
-        kwargs['multi'] = True
-        choices = []
+    model = instance.__class__.__name__
+    handle = instance.handle_string
+    data = membership_data(instance)
 
-        if not dry: # kwargs['dry'] means dry run (don't fill choices  from db)
+    with app.db.atomic():
 
-            try:
-                for tag in Tag.select():
-                    choices.append((tag, tag.name))
+        bound = set([tag_id for (tag_id,) in TagBinding.select(TagBinding.tag).where(TagBinding.model == model, TagBinding.handle == handle).tuples()])
+        indexed = set([tag_id for (tag_id,) in TagMembership.select(TagMembership.tag).where(TagMembership.model == model, TagMembership.handle == handle).tuples()])
 
-            except (peewee.OperationalError, peewee.ProgrammingError) as e:
-                app.logger.error("Failed building list of tags for TaggingField: %s" % e.message)
+        added = bound - indexed
+        removed = indexed - bound
 
-        kwargs['choices'] = choices
-        kwargs['type'] = poobrains.form.types.StorableInstanceParamType(Tag)
+        if removed:
+            TagMembership.delete().where(TagMembership.model == model, TagMembership.handle == handle, TagMembership.tag.in_(list(removed))).execute()
+            adjust_item_counts(removed, -1)
 
-        super(TaggingField, self).__init__(**kwargs)
+        if indexed - removed:
+            TagMembership.update(**data).where(TagMembership.model == model, TagMembership.handle == handle).execute()
+
+        if added:
+
+            now = datetime.datetime.now()
+            rows = []
+            for tag_id in added:
+                row = {'date': now}
+                row.update(data)
+                row['tag'] = tag_id
+                rows.append(row)
+
+            TagMembership.insert_many(rows).execute()
+            adjust_item_counts(added, 1)
+
+    if indexed or added: # the update alone can change which rows pass permission predicates
+        poobrains.storage.evict_counts(TagMembership)
+
+    return added | removed
+
+
+def evict_tag_fragments(tag_ids):
+
+    """ Drop cached renderings of tags, after their item counts changed. """
+
+    if tag_ids:
+        poobrains.storage.evict_fragments(Tag.__name__)
+
+
+@poobrains.storage.on_write
+def update_tag_memberships(instance, op):
+
+    if isinstance(instance, TagBinding):
+
+        try:
+            taggable = Taggable.class_children_keyed()[instance.model]
+            instance = taggable.load(instance.handle)
+        except (KeyError, peewee.DoesNotExist):
+            return
+
+        op = 'update'
+
+    if not isinstance(instance, Taggable):
+        return
+
+    if op == 'delete':
+
+        model = instance.__class__.__name__
+        handle = instance.handle_string
+
+        with app.db.atomic():
+            changed = set([tag_id for (tag_id,) in TagMembership.select(TagMembership.tag).where(TagMembership.model == model, TagMembership.handle == handle).tuples()])
+            TagMembership.delete().where(TagMembership.model == model, TagMembership.handle == handle).execute()
+            adjust_item_counts(changed, -1)
+
+        poobrains.storage.evict_counts(TagMembership)
+
+    else:
+        changed = sync_memberships(instance)
+
+    evict_tag_fragments(changed)
+
+
+@poobrains.storage.on_reindex
+def reindex_tag_memberships(cls, instances):
+
+    """
+    Rebuild the TagMemberships of a batch of Taggables in bulk: per chunk of
+    handles one select of bindings, one of the old memberships, one delete
+    and chunked inserts, then one recount of the affected tags.
+    """
+
+    if not issubclass(cls, Taggable):
+        return
+
+    model = cls.__name__
+    instances = dict([(instance.handle_string, instance) for instance in instances])
+
+    changed = set()
+    rows = []
+    now = datetime.datetime.now()
+
+    for handles in peewee.chunked(list(instances.keys()), 500): # keeps the number of query parameters below database limits
+
+        bound = TagBinding.select(TagBinding.handle, TagBinding.tag).where(TagBinding.model == model, TagBinding.handle.in_(handles)).tuples()
+
+        dates = {} # (handle, tag id) -> date of the old membership, kept for items without a date of their own
+        for handle, tag_id, date in TagMembership.select(TagMembership.handle, TagMembership.tag, TagMembership.date).where(TagMembership.model == model, TagMembership.handle.in_(handles)).tuples():
+            dates[(handle, tag_id)] = date
+            changed.add(tag_id)
+
+        TagMembership.delete().where(TagMembership.model == model, TagMembership.handle.in_(handles)).execute()
+
+        for handle, tag_id in bound:
+
+            row = {'date': dates.get((handle, tag_id), now)}
+            row.update(membership_data(instances[handle]))
+            row['tag'] = tag_id
+            rows.append(row)
+            changed.add(tag_id)
+
+    for chunk in peewee.chunked(rows, 100):
+        TagMembership.insert_many(chunk).execute()
+
+    recount_tag_ids(changed)
+    poobrains.storage.evict_counts(TagMembership)
+    evict_tag_fragments(changed)
+
+
+def recount_tag_ids(tag_ids):
+
+    if tag_ids:
+        counts = TagMembership.select(peewee.fn.COUNT(TagMembership.id)).where(TagMembership.tag == Tag.id)
+        Tag.update(item_count=counts).where(Tag.id.in_(list(tag_ids))).execute()
+        poobrains.storage.evict_counts(Tag)
+
+
+@poobrains.storage.on_reindex
+def recount_tags(cls, instances):
+
+    """ Repair drifted item counts. Reindex Taggables before Tag for this to count their memberships. """
+
+    if not issubclass(cls, Tag):
+        return
+
+    recount_tag_ids([tag.id for tag in instances])
+
+
+def upgrade():
+
+    """
+    Bring tags of sites installed before materialized paths and memberships
+    up to date: add missing columns and the prefix index on path, then
+    backfill paths, memberships and item counts. Does next to nothing if
+    everything is in place already, called by the install and reindex commands.
+    """
+
+    table = Tag._meta.table_name
+    columns = [column.name for column in app.db.get_columns(table)]
+    missing = [field for field in (Tag.path, Tag.item_count) if field.column_name not in columns]
+
+    if missing:
+        migrator = migrate.SchemaMigrator.from_database(app.db)
+        migrate.migrate(*[migrator.add_column(table, field.column_name, field) for field in missing])
+
+    if not isinstance(app.db, peewee.SqliteDatabase): # postgres, the regular index only serves LIKE in the C locale
+        app.db.execute_sql("CREATE INDEX IF NOT EXISTS %s_path_pattern ON %s (path text_pattern_ops)" % (table, table))
+
+    with app.db.atomic():
+
+        unbuilt = list(Tag.select().where(Tag.path.is_null()))
+        if unbuilt:
+            reindex_tag_paths(Tag, unbuilt)
+            app.logger.info("Built paths of %d tags." % len(unbuilt))
+
+        if not TagMembership.select().exists() and TagBinding.select().exists():
+
+            for cls in Taggable.class_children():
+                for batch in peewee.chunked(cls.select().iterator(), 1000):
+                    reindex_tag_memberships(cls, batch)
+
+            app.logger.info("Built tag memberships.")
+
+
+class TaggingField(poobrains.storage.fields.StorableChoice):
+
+    """ Choose tags by name, suggested by the autocomplete endpoint. """
+
+    storable = Tag
+    multi = True
 
 
 poobrains.form.fields.TaggingField = TaggingField
@@ -203,7 +532,7 @@ poobrains.form.fields.TaggingField = TaggingField
 class TaggingFieldset(poobrains.form.Fieldset):
 
     title = 'Tags'
-    tags = TaggingField(name='tags', dry=True) # dry in order not to require a database for importing the module
+    tags = TaggingField(name='tags')
 
     def __init__(self, instance):
 
@@ -214,7 +543,10 @@ class TaggingFieldset(poobrains.form.Fieldset):
 
     def process(self, submit, instance):
 
+        instance._tags = None # forget prefetched tags
         q = TagBinding.delete().where(TagBinding.model == instance.__class__.__name__, TagBinding.handle == instance.handle_string).execute()
+        poobrains.storage.evict_fragments(instance.__class__.__name__) # bulk delete doesn't trigger write hooks
+        poobrains.storage.evict_counts(TagBinding)
         for tag in self.fields['tags'].value:
 
             binding = TagBinding()
@@ -224,9 +556,13 @@ class TaggingFieldset(poobrains.form.Fieldset):
             binding.priority = 42 # FIXME
             binding.save()
 
+        evict_tag_fragments(sync_memberships(instance)) # bulk delete doesn't trigger write hooks, matters if no tags are left
+
 
 class Taggable(poobrains.auth.NamedOwned):
 
+    _tags = None # filled by prefetch_tags
+
     class Meta:
         abstract = True
 
@@ -242,8 +578,34 @@ class Taggable(poobrains.auth.NamedOwned):
     @property
     def tags(self):
 
-        tags = []
-        for binding in TagBinding.select().where(TagBinding.model == self.__class__.__name__, TagBinding.handle == self.handle_string):
-            tags.append(binding.tag)
+        if self._pk is None:
+            return []
+
+        if self._tags is None:
+            prefetch_tags([self])
+
+        return self._tags
+
+
+@poobrains.storage.on_prefetch
+def prefetch_tags(instances):
+
+    """ Load the tags of all Taggables in `instances` with one query and attach them. """
+
+    taggables = [instance for instance in instances if isinstance(instance, Taggable) and instance._pk is not None]
+    if not taggables:
+        return
+
+    poobrains.helpers.page_depends_on(TagBinding, Tag)
+
+    references = poobrains.storage.instance_references(taggables)
+    tags_by_key = dict([(reference, []) for reference in references])
+
+    clause = poobrains.storage.reference_clause(TagBinding, poobrains.storage.group_handles(references))
+    bindings = TagBinding.select(TagBinding, Tag).join(Tag).where(clause).order_by(*TagBinding._meta.order_by)
+
+    for binding in bindings: # binding.tag comes with the join, no query per binding
+        tags_by_key[(binding.model, binding.handle)].append(binding.tag)
 
-        return tags
+    for instance in taggables:
+        instance._tags = tags_by_key[(instance.__class__.__name__, instance.handle_string)]
@@ -181,6 +181,15 @@ def test_cert_page(client):
     assert rv.status_code == 200, "Expected status code 200 at /cert/, got %d" % rv.status_code
 
 
+def test_autocomplete_unprotected(client):
+
+    assert not poobrains.commenting.Challenge in poobrains.auth.autocomplete_targets(), "Autocompletion offered for unprotected Challenge!"
+    assert poobrains.tagging.Tag in poobrains.auth.autocomplete_targets(), "No autocompletion for Tag, the storable of TaggingField!"
+
+    rv = client.get('/autocomplete/Challenge/?q=a') # anonymous, no client certificate
+    assert rv.status_code == 404, "Expected status code 404 at /autocomplete/Challenge/, got %d" % rv.status_code
+
+
 def test_redeem_token(client):
 
     token = poobrains.auth.ClientCertToken.get() # loads the token created by test_cli_install
@@ -490,6 +499,72 @@ def test_ownedpermission_own_instance(client, cls, permission_holder, op_info):
         raise AssertionError("%s-assigned OwnedPermission check on %s for '%s' with own_instance access '%s' does not allow access!" % (permission_holder, cls.__name__, op, op_abbr))
 
 
+def test_lru_cache():
+
+    cache = poobrains.caching.LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a') # makes 'b' the least recently used entry
+    cache.set('c', 3)
+
+    assert 'a' in cache and 'c' in cache, "LRUCache dropped recently used entries!"
+    assert not 'b' in cache, "LRUCache didn't drop least recently used entry!"
+
+    cache.set('dead', 4, expires=0)
+    assert cache.get('dead') is None, "LRUCache returned expired entry!"
+
+    assert cache.evict(lambda key, value: value == 3) == 1
+    assert not 'c' in cache, "LRUCache.evict didn't remove matching entry!"
+
+
+def test_class_registry():
+
+    def walk(cls):
+
+        children = set()
+        for child in cls.__subclasses__():
+            if not child._meta.abstract:
+                children.add(child)
+            children |= walk(child)
+
+        return children
+
+    for cls in (poobrains.rendering.Renderable, poobrains.storage.Storable, poobrains.auth.Permission):
+        assert cls.class_children() == walk(cls), "Class registry out of sync for %s!" % cls.__name__
+
+    class RegistryProbe(poobrains.rendering.Renderable):
+        pass
+
+    assert RegistryProbe in poobrains.rendering.Renderable.class_children(), "Class registry didn't pick up new subclass!"
+    assert poobrains.rendering.Renderable.class_children_keyed(lower=True)['registryprobe'] is RegistryProbe
+
+
+def test_keyset_ordering():
+
+    ordering = poobrains.commenting.Comment.keyset_ordering()
+    assert [o.node.name for o in ordering] == ['created', 'id'], "Keyset ordering for Comment isn't made total by its primary key!"
+
+    ordering = poobrains.auth.UserPermission.keyset_ordering()
+    assert [o.node.name for o in ordering] == ['user', 'permission'], "Keyset ordering duplicates primary key fields already in order_by!"
+
+
+def test_build_threads():
+
+    Comment = poobrains.commenting.Comment
+
+    root = Comment(id=1)
+    reply = Comment(id=2, reply_to=1)
+    nested = Comment(id=3, reply_to=2)
+    orphan = Comment(id=4, reply_to=42) # parent not among the comments
+
+    threads = Comment.build_threads([root, reply, nested, orphan])
+
+    assert list(threads.keys()) == [root, orphan], "Wrong thread roots!"
+    assert list(threads[root].keys()) == [reply], "Reply not attached to its parent!"
+    assert list(threads[root][reply].keys()) == [nested], "Nested reply not attached to its parent!"
+    assert root.child_comments() == [reply], "Children of comment not filled!"
+
+
 def run_all():
 
     # kill any previous install
@@ -0,0 +1,63 @@
+// Fills the datalists of StorableChoice fields from the autocomplete endpoint while typing.
+// Without javascript, these fields still work as plain text inputs for handles.
+
+(function () {
+
+    'use strict';
+
+    var timeout = null;
+
+    function fill(input) {
+
+        var datalist = document.getElementById(input.getAttribute('list'));
+        var request = new XMLHttpRequest();
+
+        request.open('GET', input.dataset.autocomplete + '?q=' + encodeURIComponent(input.value));
+        request.onload = function () {
+
+            if (request.status !== 200) {
+                return;
+            }
+
+            datalist.innerHTML = '';
+            JSON.parse(request.responseText).forEach(function (choice) {
+                var option = document.createElement('option');
+                option.value = choice[0];
+                option.label = choice[1];
+                datalist.appendChild(option);
+            });
+        };
+        request.send();
+    }
+
+    function extend(input) {
+
+        // multi fields: keep one empty input at the end for adding another value
+        var last = input.parentNode.querySelectorAll('input[name="' + input.name + '"]');
+        last = last[last.length - 1];
+
+        if (last === input && input.value !== '') {
+            var clone = input.cloneNode(false);
+            clone.removeAttribute('id');
+            clone.removeAttribute('required');
+            clone.value = '';
+            input.parentNode.insertBefore(clone, input.nextSibling);
+        }
+    }
+
+    document.addEventListener('input', function (event) {
+
+        var input = event.target;
+        if (!input.dataset || !input.dataset.autocomplete) {
+            return;
+        }
+
+        if (input.parentNode.querySelectorAll('input[name="' + input.name + '"]').length > 1) {
+            extend(input);
+        }
+
+        window.clearTimeout(timeout);
+        timeout = window.setTimeout(function () { fill(input); }, 200);
+    });
+
+}());